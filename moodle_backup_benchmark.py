@@ -0,0 +1,434 @@
+#Benchmarks for moodle_backup_organize.py
+#Run as python3 moodle_backup_benchmark.py [benchmark ...]
+#With no arguments, runs all of the benchmarks
+
+import os
+import sys
+import subprocess
+import resource
+import tempfile
+import shutil
+import hashlib
+import tarfile
+import time
+import io
+import random
+import html
+import itertools
+import urllib.parse
+import tracemalloc
+import xml.etree.ElementTree as etree
+
+import moodle_backup_synthetic as synthetic
+
+import moodle_backup_organize as mbo
+
+#Numbers of files.xml entries (and questions) to measure at
+MEMORY_COUNTS = [1000, 10000, 100000, 300000]
+
+#One in this many questions is used by a quiz, for the questions-used loader
+USED_EVERY = 20
+
+#Numbers of files.xml entries to measure the file catalog at
+CATALOG_COUNTS = [10000, 100000, 1000000]
+
+#Numbers of embedded files per page to measure make_html at
+HTML_COUNTS = [100, 1000, 3000]
+
+#Sizes of synthetic backups to run the stages benchmark on
+#(see moodle_backup_synthetic.generate_backup)
+STAGE_SCALES = [
+    {'files' : 500, 'questions' : 200, 'activities' : 50},
+    {'files' : 5000, 'questions' : 2000, 'activities' : 500},
+]
+
+#Size of the synthetic backup to time verifying its files on
+VERIFY_SCALE = {'files' : 400, 'min_size' : 256 * 1024,\
+    'max_size' : 1024 * 1024, 'questions' : 10, 'activities' : 10}
+
+#Write a synthetic files.xml with count entries to path
+#Every third entry is an alias of an earlier blob, as in real backups
+#With fanout, every entry is the same blob, under a different name in a
+#different context (as with a logo or stock image used everywhere)
+def write_files_xml(path, count, fanout = False):
+    with open(path, 'w') as out:
+        out.write('<?xml version="1.0" encoding="UTF-8"?>\n<files>\n')
+        for i in range(count):
+            hash = hashlib.sha1(str(0 if fanout else i - i % 3)\
+                .encode()).hexdigest()
+            out.write('  <file id="%d">\n'
+                '    <contenthash>%s</contenthash>\n'
+                '    <contextid>%d</contextid>\n'
+                '    <component>mod_resource</component>\n'
+                '    <filearea>content</filearea>\n'
+                '    <itemid>0</itemid>\n'
+                '    <filepath>/</filepath>\n'
+                '    <filename>file_%d.pdf</filename>\n'
+                '    <userid>2</userid>\n'
+                '    <filesize>1024</filesize>\n'
+                '    <mimetype>application/pdf</mimetype>\n'
+                '  </file>\n' % (i, hash, i if fanout else i % 500, i))
+        out.write('</files>\n')
+
+#Write a synthetic questions.xml with count multichoice questions to path
+def write_questions_xml(path, count):
+    with open(path, 'w') as out:
+        out.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<question_categories>\n')
+        for i in range(count):
+            if i % 100 == 0:
+                if i > 0:
+                    out.write('</questions></question_category>\n')
+                out.write('<question_category id="%d"><name>Category %d'
+                    '</name><questions>\n' % (i, i))
+            out.write('<question id="%d"><name>Q%d</name>'
+                '<questiontext>&lt;p&gt;What is %d + %d?&lt;/p&gt;'
+                '</questiontext><qtype>multichoice</qtype>'
+                '<plugin_qtype_multichoice_question><answers>' % (i, i, i, i))
+            for j in range(4):
+                out.write('<answer id="%d"><answertext>%d</answertext>'
+                    '<fraction>%s</fraction><feedback>Try again</feedback>'
+                    '</answer>' % (i * 4 + j, i + j,
+                        '1.0000000' if j == 0 else '0.0000000'))
+            out.write('</answers></plugin_qtype_multichoice_question>'
+                '</question>\n')
+        if count > 0:
+            out.write('</questions></question_category>\n')
+        out.write('</question_categories>\n')
+
+#The way files.xml and questions.xml used to be loaded: whole tree first
+def load_files_tree(path):
+    collector = mbo.FileCollector()
+    for file_entry in etree.parse(path).getroot():
+        collector.add(file_entry.find('contenthash').text,\
+            file_entry.find('filename').text,\
+            file_entry.find('contextid').text)
+    return collector.files()
+
+def load_questions_tree(path):
+    questions = dict()
+    for question_category in etree.parse(path).getroot():
+        for question_node in question_category.find('questions'):
+            questions[question_node.attrib['id']] =\
+                mbo.parse_question(question_node)
+    return questions
+
+def load_files_stream(path):
+    with open(path, 'rb') as fin:
+        return mbo.load_files(fin)
+
+def load_questions_stream(path):
+    with open(path, 'rb') as fin:
+        return mbo.load_questions(fin)
+
+#Only the questions a backup's quizzes use, taken to be one in USED_EVERY
+#(from a path, or an open file)
+def load_questions_used(path):
+    with open(path, 'rb') if isinstance(path, str) else path as fin:
+        return mbo.load_questions(fin, set(str(i) for i in\
+            range(0, MEMORY_COUNTS[-1], USED_EVERY)))
+
+#Both files.xml and the questions used, from a .mbz (tar.gz) file
+#containing them, as when organizing one
+def load_mbz(path):
+    backup = mbo.open_backup(path)
+    with backup.open(mbo.FILES_XML) as fin:
+        files = mbo.load_files(fin)
+    questions = load_questions_used(backup.open(mbo.QUESTIONS_XML))
+    backup.close()
+    return files, questions
+
+LOADERS = {'files-tree' : load_files_tree,
+    'files-stream' : load_files_stream,
+    'questions-tree' : load_questions_tree,
+    'questions-stream' : load_questions_stream,
+    'questions-used' : load_questions_used,
+    'mbz' : load_mbz}
+
+#Peak RSS of this process, in KiB
+def peak_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+#Run one loader in a fresh process, returning its peak RSS above baseline
+def measure_loader(loader, path):
+    output = subprocess.run([sys.executable, __file__, '_measure', loader,
+        path], check=True, capture_output=True, text=True).stdout
+    return int(output.split()[-1])
+
+#Peak RSS while loading files.xml and questions.xml, tree vs streaming,
+#and loading only the questions used, from loose files and from a .mbz
+#file (in which the XML has to be read in one pass, before anything else)
+def bench_memory():
+    print("Peak RSS above interpreter baseline (KiB)")
+    print("%10s %12s %12s %12s %12s %12s %12s" % ('count', 'files-tree',
+        'files-stream', 'quest-tree', 'quest-stream', 'quest-used', 'mbz'))
+    with tempfile.TemporaryDirectory() as tmp:
+        files_path = os.path.join(tmp, mbo.FILES_XML)
+        questions_path = os.path.join(tmp, mbo.QUESTIONS_XML)
+        mbz_path = os.path.join(tmp, 'backup' + mbo.BACKUP_EXTENSION)
+        for count in MEMORY_COUNTS:
+            write_files_xml(files_path, count)
+            write_questions_xml(questions_path, count // 10)
+            with tarfile.open(mbz_path, 'w:gz') as archive:
+                archive.add(files_path, mbo.FILES_XML)
+                archive.add(questions_path, mbo.QUESTIONS_XML)
+            results = [measure_loader(loader, files_path)\
+                for loader in ('files-tree', 'files-stream')]
+            results += [measure_loader(loader, questions_path)\
+                for loader in ('questions-tree', 'questions-stream',\
+                'questions-used')]
+            results.append(measure_loader('mbz', mbz_path))
+            print("%10d %12d %12d %12d %12d %12d %12d" %\
+                tuple([count] + results))
+
+#MoodleFile as it used to be: a dict of attributes for every file, plus a
+#dict mapping each of its names to itself and a set of its contexts
+class LegacyMoodleFile:
+    def __init__(self, hash, name, context_id):
+        self.names = {name : name}
+        self.initial_name = name
+        self.hash = hash
+        self.context_ids = {context_id}
+        self.backup = None
+        self.member = None
+        self.paths = None
+
+    def add_context(self, context_id):
+        self.context_ids.add(context_id)
+
+    def add_name(self, name):
+        self.names[name] = name
+
+#The way the files used to be cataloged: LegacyMoodleFiles by hash, with
+#nothing interned, and a list of them for each context
+def catalog_files_legacy(path):
+    files = dict()
+    with open(path, 'rb') as fin:
+        for file_entry in mbo.iter_elements(fin, mbo.FILE_PATH):
+            hash = file_entry.findtext('contenthash')
+            name = file_entry.findtext('filename')
+            context_id = file_entry.findtext('contextid')
+            if hash in files:
+                files[hash].add_name(name)
+                files[hash].add_context(context_id)
+            else:
+                files[hash] = LegacyMoodleFile(hash, name, context_id)
+    files_by_context = dict()
+    for file in files.values():
+        for context_id in file.context_ids:
+            files_by_context.setdefault(context_id, []).append(file)
+    return files, files_by_context
+
+def catalog_files_compact(path):
+    with open(path, 'rb') as fin:
+        files = mbo.load_files(fin)
+    return files, mbo.ContextIndex(files)
+
+#Memory held by the file catalog (the files by hash and by context), and
+#the time taken to build it from files.xml, before and after making it
+#compact, for typical backups and for ones where a single blob has a
+#name and context for every entry
+def bench_catalog():
+    print("Memory held (KiB) and seconds to build the file catalog")
+    print("%10s %8s %12s %12s %12s %12s" % ('count', 'layout',
+        'legacy KiB', 'compact KiB', 'legacy s', 'compact s'))
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, mbo.FILES_XML)
+        for count, fanout in itertools.product(CATALOG_COUNTS,\
+                (False, True)):
+            write_files_xml(path, count, fanout)
+            held = []
+            times = []
+            for build in (catalog_files_legacy, catalog_files_compact):
+                start = time.perf_counter()
+                catalog = build(path)
+                times.append(time.perf_counter() - start)
+                del catalog
+                tracemalloc.start()
+                catalog = build(path)
+                held.append(tracemalloc.get_traced_memory()[0] // 1024)
+                tracemalloc.stop()
+                del catalog
+            print("%10d %8s %12d %12d %12.2f %12.2f" % tuple([count,\
+                'fan-out' if fanout else 'typical'] + held + times))
+
+#The way make_html used to rewrite @@PLUGINFILE@@ references: search the
+#body for each one, scan every file for it, and rebuild the body each time
+#(Without the query string handling, which was broken)
+def make_html_legacy(aname, content, context_files):
+    body = html.unescape(content)
+    embedded_indices = set()
+    while (index := body.find(mbo.MOODLE_PLUGIN_FILE)) != -1:
+        findex = index + len(mbo.MOODLE_PLUGIN_FILE)
+        quote_index = body.find('"', findex)
+        filename = urllib.parse.unquote(body[findex:quote_index])
+        found = False
+        for i in range(len(context_files)):
+            if filename in context_files[i].aliases:
+                embedded_indices.add(i)
+                body = body[:index] + os.path.join(mbo.NEW_FILES_DIR,\
+                    context_files[i].new_name(filename)) +\
+                    body[quote_index:]
+                found = True
+                break
+        if not found:
+            raise ValueError("File %s not found" % filename)
+    for i in range(len(context_files)):
+        if not i in embedded_indices:
+            file = context_files[i]
+            body += '\n<li><a href="%s">%s</a></li>' %\
+                (os.path.join(mbo.NEW_FILES_DIR,\
+                    file.new_name(file.aliases[0])), file.aliases[0])
+    return "<html>\n<head><title>%s</title></head>\n<body>%s</body>\n"\
+        "</html>" % (aname, body)
+
+#A synthetic page embedding count images, each with some text around it
+def synthetic_page(count):
+    files = [mbo.MoodleFile('%040x' % i, 'image %d.png' % i, '1')\
+        for i in range(count)]
+    content = ''.join('&lt;p&gt;Paragraph %d of some lecture notes.&lt;/p&gt;'
+        '&lt;img src="@@PLUGINFILE@@/image%%20%d.png" alt="Figure %d"&gt;'\
+        % (i, i, i) for i in range(count))
+    return content, files
+
+#Time make_html against its old implementation on synthetic pages
+def bench_html():
+    print("Seconds per page")
+    print("%10s %12s %12s" % ('embeds', 'legacy', 'indexed'))
+    for count in HTML_COUNTS:
+        content, files = synthetic_page(count)
+        results = []
+        for make in (make_html_legacy, mbo.make_html):
+            start = time.perf_counter()
+            make('Synthetic page', content, files)
+            results.append(time.perf_counter() - start)
+        print("%10d %12.4f %12.4f" % tuple([count] + results))
+
+#Organize the backup at path into dest with organize, as from the command
+#line, but without any output
+#Returns the statistics for the run (see RunStats.report)
+def run_organize(path, dest, trace_memory = False, **options):
+    if trace_memory:
+        tracemalloc.start()
+    try:
+        return mbo.organize(path, dest, progress = mbo.Progress(mbo.QUIET,\
+            out = io.StringIO()), **options)
+    finally:
+        if trace_memory:
+            tracemalloc.stop()
+
+#Time each stage of organizing synthetic backups with organize, and the
+#peak memory allocated during it, along with the whole run, the whole run
+#with --pipeline, and a rerun on the same destination (in which nothing
+#has changed)
+def bench_stages():
+    for scale in STAGE_SCALES:
+        print("Synthetic backup: %s" % ', '.join('%s=%s' % item\
+            for item in scale.items()))
+        print("%15s %12s %12s %12s" % ('stage', 'seconds', 'cpu seconds',\
+            'peak KiB'))
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'backup')
+            synthetic.generate_backup(path, **scale)
+            timed = run_organize(path, os.path.join(tmp, 'timed'))
+            traced = run_organize(path, os.path.join(tmp, 'traced'), True)
+            pipelined = run_organize(path, os.path.join(tmp, 'pipelined'),\
+                pipeline = True)
+            rerun = run_organize(path, os.path.join(tmp, 'timed'))
+        for name in mbo.STAGES:
+            if name not in timed['stages']:
+                continue
+            stage = timed['stages'][name]
+            peak = traced['stages'][name].get('peak_bytes')
+            print("%15s %12.4f %12.4f %12s" % (name, stage['wall'],\
+                stage['cpu'], peak // 1024 if peak is not None else '-'))
+        for name, run in (('total', timed), ('pipelined', pipelined),\
+                ('rerun', rerun)):
+            print("%15s %12.4f %12.4f" % (name, run['total']['wall'],\
+                run['total']['cpu']))
+        print()
+    print("Peak RSS of this process: %d KiB" % peak_rss())
+
+#Copy all of the files of the backup at path into a fresh dest, jobs at a
+#time, verifying them if verify is True
+#Returns the time taken, in seconds
+def time_copy(path, dest, jobs, verify):
+    os.makedirs(os.path.join(dest, mbo.NEW_FILES_DIR))
+    mbo.content_created.clear()
+    backup = mbo.open_backup(path)
+    with backup.open(mbo.FILES_XML) as xml_in:
+        files = mbo.load_files(xml_in)
+    verifier = mbo.Verifier(jobs) if verify else None
+    start = time.perf_counter()
+    for file, created in mbo.copy_files(backup, files, dest, jobs,\
+            verifier = verifier):
+        pass
+    elapsed = time.perf_counter() - start
+    if verifier is not None:
+        verifier.close()
+    backup.close()
+    shutil.rmtree(dest)
+    return elapsed
+
+#Time copying the files of a synthetic backup with and without verifying
+#them, from a directory and from a .mbz file
+def bench_verify():
+    print("Seconds to copy the files of a synthetic backup: %s" %\
+        ', '.join('%s=%s' % item for item in VERIFY_SCALE.items()))
+    print("%15s %12s %12s %12s" % ('source', 'copy', 'verify', 'overhead'))
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'backup')
+        synthetic.generate_backup(path, **VERIFY_SCALE)
+        synthetic.pack_backup(path, path + mbo.BACKUP_EXTENSION)
+        dest = os.path.join(tmp, 'dest')
+        for name, source, jobs in [('directory', path, 1),\
+                ('directory x4', path, 4),\
+                ('.mbz', path + mbo.BACKUP_EXTENSION, 1)]:
+            #Once first, so that the backup is cached either way
+            time_copy(source, dest, jobs, False)
+            plain = time_copy(source, dest, jobs, False)
+            verified = time_copy(source, dest, jobs, True)
+            print("%15s %12.3f %12.3f %11.1f%%" % (name, plain, verified,\
+                100 * (verified / plain - 1)))
+
+#Not timed: check that a synthetic questions.xml with Cloze (multianswer)
+#questions loads, with every question found once, and nothing mistaken
+#for a question that isn't one (their parts are listed in a nested
+#question element, which once broke loading questions.xml)
+def check_cloze():
+    count = 500
+    with tempfile.TemporaryDirectory() as tmp:
+        synthetic.generate_questions(tmp, random.Random(0), count)
+        with open(os.path.join(tmp, mbo.QUESTIONS_XML), 'rb') as fin:
+            questions = mbo.load_questions(fin)
+    cloze = sum(1 for question in questions.values()\
+        if question['type'] == 'multianswer')
+    if sorted(questions, key = int) != [str(i + 1) for i in range(count)]\
+            or cloze == 0:
+        print("FAILED: loaded %d of %d questions (%d Cloze)" %\
+            (len(questions), count, cloze))
+        sys.exit(1)
+    print("Loaded all %d questions (%d Cloze)" % (count, cloze))
+
+BENCHMARKS = {'memory' : bench_memory, 'catalog' : bench_catalog,\
+    'html' : bench_html, 'stages' : bench_stages, 'verify' : bench_verify,\
+    'cloze' : check_cloze}
+
+if __name__ == '__main__':
+    #Internal: measure a single loader (see measure_loader)
+    if len(sys.argv) == 4 and sys.argv[1] == '_measure':
+        baseline = peak_rss()
+        result = LOADERS[sys.argv[2]](sys.argv[3])
+        print(peak_rss() - baseline)
+        sys.exit(0)
+
+    names = sys.argv[1:] if len(sys.argv) > 1 else list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            print("Unknown benchmark %s; choose from %s" %\
+                (name, ', '.join(BENCHMARKS)))
+            sys.exit(1)
+    for name in names:
+        print("== %s ==" % name)
+        BENCHMARKS[name]()
+        print()
@@ -1,6 +1,6 @@
 #Organize stuff downloaded from a Moodle backup file
-#Be sure to extract the backup's contents into a directory first
-#(Rename it to .ZIP and extract into a directory)
+#Works on either the backup (.mbz) file itself or a directory
+#its contents have been extracted into
 
 #Some of this code is based on code found at
 #http://www.reades.com/2012/11/29/mb-archives/
@@ -11,7 +11,27 @@ import os
 import sys
 import re
 import html
-import urllib
+import urllib.parse
+import io
+import tempfile
+import posixpath
+import tarfile
+import zipfile
+import argparse
+import concurrent.futures
+import threading
+import hashlib
+import json
+import collections
+import collections.abc
+import contextlib
+import time
+import cProfile
+import tracemalloc
+import sqlite3
+import array
+import http.server
+import mimetypes
 
 #One dependency
 #Can run without, but risk of errors
@@ -24,11 +44,26 @@ except ImportError:
         "pip install pathvalidate.")
     HAS_PATHVALIDATE = False
 
+#Needed for reflinks, which aren't available without it anyway
+try:
+    import fcntl
+    HAS_FCNTL = True
+except ImportError:
+    HAS_FCNTL = False
+
 FILES_XML = 'files.xml'
 CONTENT_XML = 'moodle_backup.xml'
 QUESTIONS_XML = 'questions.xml'
 
 INDEX_FILENAME = 'index.html'
+MANIFEST_FILENAME = 'organize_manifest.json'
+CATALOG_FILENAME = 'organize_catalog.sqlite'
+JOURNAL_FILENAME = 'organize_journal.jsonl'
+
+#Outputs are written to temporary files named like this first (see
+#atomic_path)
+TEMP_PREFIX = '.organize-'
+TEMP_SUFFIX = '.tmp'
 
 NEW_FILES_DIR = 'content'
 NEW_HTML_DIR = 'html'
@@ -44,7 +79,18 @@ QUIZ = 'quiz'
 ACTIVITY_NAMES = {ASSIGNMENT : 'Assignments', PAGE : 'Pages', URL : 'URLs',\
     RESOURCE : 'Resources', FOLDER : 'Folders', QUIZ : 'Quizzes'}
 
+#Where the elements read one at a time are (see iter_elements): files in
+#files.xml, questions in questions.xml, and the IDs of the questions in a
+#quiz's XML
+FILE_PATH = ['file']
+QUESTION_PATH = ['question_category', 'questions', 'question']
+QUIZ_QUESTION_ID_PATH = [QUIZ, 'question_instances', 'question_instance',\
+    'questionid']
+
 MOODLE_PLUGIN_FILE = '@@PLUGINFILE@@/'
+#A reference to an embedded file, up to the end of the quoted URL
+PLUGIN_FILE_PATTERN = re.compile(re.escape(MOODLE_PLUGIN_FILE) +
+    r'([^"\'<>]*)')
 
 DUPLICATE_PROTECTION_SUFFIX = '_'
 
@@ -52,127 +98,1219 @@ FILE_EXISTS = 0
 SUCCESS = 1
 FAILURE = -1
 UNSUPPORTED = 2
+UNCHANGED = 3
 UNKNOWN = 999
 
+#How statuses are named in reports
+STATUS_NAMES = {FILE_EXISTS : 'FILE_EXISTS', SUCCESS : 'SUCCESS',\
+    FAILURE : 'FAILURE', UNSUPPORTED : 'UNSUPPORTED',\
+    UNCHANGED : 'UNCHANGED', UNKNOWN : 'UNKNOWN'}
+
+#Ways of putting files in place
+LINK_COPY = 'copy'
+LINK_HARDLINK = 'hardlink'
+LINK_REFLINK = 'reflink'
+LINK_SYMLINK = 'symlink'
+LINK_MODES = [LINK_COPY, LINK_HARDLINK, LINK_REFLINK, LINK_SYMLINK]
+
+#Size of the chunks files are copied in by hand
+COPY_CHUNK_SIZE = 1024 * 1024
+
+#XML in a tar file bigger than this is kept on disk, rather than in
+#memory, until it's needed (see BackupTar)
+XML_SPOOL_SIZE = 1024 * 1024
+
+#Size of the chunks files are hashed in while they're copied (see
+#Verifier), small enough to stay in the CPU's cache between the two
+VERIFY_CHUNK_SIZE = 256 * 1024
+
+#Linux ioctl to clone a file's data (i.e. make a reflink)
+FICLONE = 0x40049409
+
 RESET_FLAG = '--reset'
+JOBS_FLAG = '--jobs'
+LINK_MODE_FLAG = '--link-mode'
+PROCESSES_FLAG = '--processes'
+BATCH_FLAG = '--batch'
+STATS_FLAG = '--stats'
+PROFILE_FLAG = '--profile'
+CATALOG_FLAG = '--catalog'
+ARCHIVE_FLAG = '--archive'
+PIPELINE_FLAG = '--pipeline'
+RESUME_FLAG = '--resume'
+MODULE_FLAG = '--module'
+NAME_FLAG = '--name'
+SECTION_FLAG = '--section'
+SERVE_FLAG = '--serve'
+VERIFY_FLAG = '--verify'
+QUIET_FLAG = '--quiet'
+VERBOSE_FLAG = '--verbose'
+LOG_FLAG = '--log'
+LOG_FORMAT_FLAG = '--log-format'
+PORT_FLAG = '--port'
+CACHE_PAGES_FLAG = '--cache-pages'
+
+#The stages of a run, as timed by RunStats
+STAGE_OPEN = 'open'
+STAGE_CATALOG = 'catalog'
+STAGE_FILES = 'files'
+STAGE_COPY = 'copy'
+STAGE_QUESTIONS = 'questions'
+STAGE_ACTIVITIES = 'activities'
+STAGE_INDEX = 'index'
+STAGES = [STAGE_OPEN, STAGE_CATALOG, STAGE_FILES, STAGE_COPY, STAGE_QUESTIONS,\
+    STAGE_ACTIVITIES, STAGE_INDEX]
+
+#Where a run's report and profile go, in its destination
+STATS_FILENAME = 'organize_stats.json'
+PROFILE_FILENAME = 'organize_%s.prof'
+
+#How many of the slowest activities to report
+SLOWEST_ACTIVITIES = 10
+
+#Changed whenever the catalog's tables do, so that old catalogs are rebuilt
+CATALOG_VERSION = 2
+
+#The tables of a catalog (see Catalog)
+#Positions are where things appear in the backup's XML, to keep its order
+CATALOG_SCHEMA = '''
+CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE files (hash TEXT PRIMARY KEY, position INTEGER);
+CREATE TABLE aliases (hash TEXT, position INTEGER, name TEXT);
+CREATE INDEX aliases_hash ON aliases (hash);
+CREATE TABLE contexts (hash TEXT, context_id TEXT);
+CREATE INDEX contexts_context_id ON contexts (context_id);
+CREATE TABLE questions (id TEXT PRIMARY KEY, type TEXT, text TEXT,
+    template TEXT, has_answers INTEGER);
+CREATE TABLE answers (question_id TEXT, position INTEGER, id TEXT,
+    text TEXT, fraction TEXT, feedback TEXT, tolerance TEXT);
+CREATE INDEX answers_question_id ON answers (question_id);
+CREATE TABLE activities (position INTEGER PRIMARY KEY, module TEXT,
+    member TEXT, name TEXT, context_id TEXT, section TEXT, xml BLOB);
+CREATE INDEX activities_module ON activities (module);
+CREATE INDEX activities_context_id ON activities (context_id);
+CREATE INDEX activities_section ON activities (section);
+CREATE TABLE sections (id TEXT PRIMARY KEY, title TEXT);
+'''
+
+#Extension of backup files
+BACKUP_EXTENSION = '.mbz'
+
+#Archive formats the output can be written as, by extension, with the
+#mode to open them in with tarfile (or None for ZIP)
+ARCHIVE_FORMATS = {'.zip' : None, '.tar' : 'w|', '.tar.gz' : 'w|gz',\
+    '.tgz' : 'w|gz', '.tar.bz2' : 'w|bz2', '.tar.xz' : 'w|xz'}
+ARCHIVE_EXTENSION = '.zip'
+
+#Where pages in an archive link to files, relative to the pages
+ARCHIVE_FILES_DIR = posixpath.join(posixpath.pardir, NEW_FILES_DIR)
+
+#Where files are stored in batch mode, and where each backup's output goes
+STORE_DIR = 'blobs'
+BATCH_LOG_FILENAME = 'organize.log'
+
+#How often the journal is synced to disk, in seconds (see Manifest)
+CHECKPOINT_INTERVAL = 5
+
+#How many activities to have in flight per worker process
+ACTIVITIES_PER_PROCESS = 4
+
+#How many activities can wait for their files to be copied, when
+#pipelining, before waiting for them
+WAITING_ACTIVITIES = 64
+
+#How much is reported on a run (see Progress)
+QUIET = 0
+NORMAL = 1
+VERBOSE = 2
+
+#Formats a run can be logged in (see Progress)
+LOG_TEXT = 'text'
+LOG_JSON = 'json'
+LOG_FORMATS = [LOG_TEXT, LOG_JSON]
+
+#How often a progress line is redrawn at most, in seconds
+PROGRESS_INTERVAL = 0.2
+
+#How much of a log is kept before it's written out, in bytes
+LOG_BUFFER_SIZE = 1024 * 1024
+
+#The port to serve previews on, and how many rendered pages to keep
+#(see serve)
+DEFAULT_PORT = 8000
+CACHE_PAGES = 64
+
+#Hands out unique paths for files, in constant time
+#The first file to want a path gets it as is; after that, a counter is
+#kept for the path, so the nth file to want it gets e.g. image_n.png
+#(skipping any that are taken)
+#Safe to share between threads (paths are only allocated in the main
+#process, so that they don't depend on how work is spread over processes)
+class NameAllocator:
+    def __init__(self):
+        self.taken = set()
+        self.counters = dict()
+        self.lock = threading.Lock()
+
+    #Allocate a unique path, as close to path as possible
+    def allocate(self, path):
+        with self.lock:
+            if path not in self.taken:
+                self.taken.add(path)
+                return path
+            #In order to do this well, need to track where the file suffix is
+            dir, name = os.path.split(path)
+            dot_index = name.rfind(".")
+            if dot_index <= 0:
+                dot_index = len(name)
+            root = os.path.join(dir, name[:dot_index])
+            count = self.counters.get(path, 1)
+            while True:
+                count += 1
+                new_path = '%s%s%d%s' % (root, DUPLICATE_PROTECTION_SUFFIX,\
+                    count, name[dot_index:])
+                if new_path not in self.taken:
+                    break
+            self.counters[path] = count
+            self.taken.add(new_path)
+            return new_path
+
+    #Mark a path as taken
+    def add(self, path):
+        with self.lock:
+            self.taken.add(path)
+
+    #Take path as is, if nothing has yet
+    #Returns whether it was taken
+    def claim(self, path):
+        with self.lock:
+            if path in self.taken:
+                return False
+            self.taken.add(path)
+            return True
+
+    def __contains__(self, path):
+        return path in self.taken
+
+    def clear(self):
+        with self.lock:
+            self.taken.clear()
+            self.counters.clear()
 
 #Track which content and html files have been created by
 #this run of this program
-content_created = set()
-html_created = set()
+content_created = NameAllocator()
+html_created = NameAllocator()
+
+#Classes representing the contents of a backup
+#Members are addressed by their path relative to the root of the backup,
+#always with forward slashes, e.g. files/ab/ab12... or
+#activities/page_12/page.xml
+
+#Clean up a member name found in an archive
+def normalize_member(name):
+    while name.startswith('./'):
+        name = name[2:]
+    return name.lstrip('/')
+
+#If member is a file blob, return its hash, otherwise None
+#Blobs are stored as files/<first two characters of hash>/<hash>
+def blob_hash(member):
+    parts = member.split('/')
+    if len(parts) == 3 and parts[0] == OLD_FILES_DIR and parts[2]:
+        return parts[2]
+    return None
+
+#Copy the file at src to dst, sharing the data between the two on
+#filesystems that support it (e.g. Btrfs, XFS), and falling back on an
+#ordinary copy otherwise
+def reflink_file(src, dst):
+    fin = os.open(src, os.O_RDONLY)
+    try:
+        fout = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        try:
+            #Try cloning the whole file
+            if HAS_FCNTL:
+                try:
+                    fcntl.ioctl(fout, FICLONE, fin)
+                    return
+                except OSError:
+                    pass
+            #Try copying within the kernel, which also shares data on
+            #some filesystems (e.g. NFS, XFS)
+            if hasattr(os, 'copy_file_range'):
+                try:
+                    remaining = os.fstat(fin).st_size
+                    while remaining > 0:
+                        copied = os.copy_file_range(fin, fout, remaining)
+                        if copied == 0:
+                            break
+                        remaining -= copied
+                    if remaining == 0:
+                        return
+                except OSError:
+                    pass
+            #Start over with an ordinary copy
+            os.lseek(fin, 0, os.SEEK_SET)
+            os.lseek(fout, 0, os.SEEK_SET)
+            os.ftruncate(fout, 0)
+            while chunk := os.read(fin, COPY_CHUNK_SIZE):
+                os.write(fout, chunk)
+        finally:
+            os.close(fout)
+    finally:
+        os.close(fin)
+
+#Put the file at src in place at dst, using the given link mode
+#Falls back on copying if the link can't be made (e.g. a hard link
+#across filesystems)
+def link_file(src, dst, link_mode = LINK_COPY):
+    if link_mode == LINK_HARDLINK:
+        try:
+            os.link(src, dst)
+            return
+        except OSError:
+            pass
+    elif link_mode == LINK_SYMLINK:
+        os.symlink(os.path.abspath(src), dst)
+        return
+    elif link_mode == LINK_REFLINK:
+        reflink_file(src, dst)
+        return
+    shutil.copyfile(src, dst)
+
+#Path to write path's contents to before they're complete, unique to
+#this process and thread, and recognised by remove_temp_files
+def temp_path(path):
+    dir, name = os.path.split(path)
+    return os.path.join(dir, '%s%s.%d.%d%s' % (TEMP_PREFIX, name,\
+        os.getpid(), threading.get_ident(), TEMP_SUFFIX))
+
+#Write to a temporary file in place of path (yielding its path), which
+#is only moved to path once it's complete, so that path never holds
+#a partial file, even if the run is interrupted
+@contextlib.contextmanager
+def atomic_path(path):
+    temp = temp_path(path)
+    try:
+        yield temp
+        os.replace(temp, path)
+    finally:
+        if os.path.lexists(temp):
+            os.remove(temp)
+
+#Remove the temporary files left in dir by an interrupted run
+def remove_temp_files(dir):
+    for entry in os.listdir(dir):
+        if entry.startswith(TEMP_PREFIX) and entry.endswith(TEMP_SUFFIX):
+            os.remove(os.path.join(dir, entry))
+
+#Where a blob with the given hash is stored in a standard backup
+def blob_member(hash):
+    return posixpath.join(OLD_FILES_DIR, hash[:2], hash)
+
+#Base class for backups
+class Backup:
+    #Can members be read in any order (and from several threads at once)?
+    random_access = True
+
+    #A fingerprint of the backup's XML, which changes whenever it does
+    #For a backup file, that's whenever the file changes
+    def fingerprint(self):
+        stat = os.stat(self.path)
+        return '%d:%d' % (stat.st_size, stat.st_mtime_ns)
+
+    #Iterate through the blobs with the given hashes, yielding
+    #(hash, member) pairs for those that are present
+    #Goes straight to where each blob should be, and only scans through
+    #all the blobs if none of them are there (i.e. a non-standard layout)
+    def find_blobs(self, hashes):
+        missing = []
+        for hash in hashes:
+            member = blob_member(hash)
+            if self.has_member(member):
+                yield hash, member
+            else:
+                missing.append(hash)
+        if missing and len(missing) == len(hashes):
+            wanted = set(missing)
+            for hash, member in self.blobs():
+                if hash in wanted:
+                    wanted.discard(hash)
+                    yield hash, member
+
+#A backup that has already been extracted into a directory
+class BackupDirectory(Backup):
+    def __init__(self, path):
+        self.path = path
+
+    #Path on disk of a member
+    def member_path(self, member):
+        return os.path.join(self.path, *member.split('/'))
+
+    #Open a member for (binary) reading
+    def open(self, member):
+        return open(self.member_path(member), 'rb')
+
+    #Is the member present?
+    def has_member(self, member):
+        return os.path.isfile(self.member_path(member))
+
+    #Size of a member, in bytes
+    def size(self, member):
+        return os.path.getsize(self.member_path(member))
+
+    #Iterate through the blobs, yielding (hash, member) pairs
+    def blobs(self):
+        old_files_dir = os.path.join(self.path, OLD_FILES_DIR)
+        for entry in os.listdir(old_files_dir):
+            full_entry = os.path.join(old_files_dir, entry)
+            if os.path.isdir(full_entry):
+                for fentry in os.listdir(full_entry):
+                    yield fentry, posixpath.join(OLD_FILES_DIR, entry, fentry)
+
+    #Copy a member to the given path, or link it there (see link_file)
+    #If a Verifier is given, the member is hashed, in the course of
+    #copying it if it's copied, and the digest returned
+    def copy_member(self, member, path, link_mode = LINK_COPY,\
+            verifier = None):
+        if verifier is None:
+            link_file(self.member_path(member), path, link_mode)
+            return None
+        if link_mode == LINK_COPY:
+            with self.open(member) as fin, open(path, 'wb') as fout:
+                return verifier.copy(fin, fout)
+        link_file(self.member_path(member), path, link_mode)
+        with self.open(member) as fin:
+            return verifier.copy(fin)
+
+    #Changes whenever any of the backup's XML files do (going by their
+    #sizes and modification times): those at the top level, and those in
+    #the directories moodle_backup.xml lists for the course's activities
+    #and sections
+    #Nothing else is looked at, since the output may be in the same
+    #directory
+    def fingerprint(self):
+        members = sorted(name for name in os.listdir(self.path)\
+            if name.endswith('.xml') and\
+            os.path.isfile(os.path.join(self.path, name)))
+        try:
+            with self.open(CONTENT_XML) as xml_in:
+                dirs = sorted(set(normalize_member(element.text) for\
+                    element in etree.parse(xml_in).iter('directory')\
+                    if element.text))
+        except (OSError, etree.ParseError):
+            dirs = []
+        for dir in dirs:
+            for subdir, subdirs, names in os.walk(self.member_path(dir)):
+                subdirs.sort()
+                members += [os.path.relpath(os.path.join(subdir, name),\
+                    self.path).replace(os.sep, '/') for name in\
+                    sorted(names) if name.endswith('.xml')]
+        digest = hashlib.sha1()
+        for member in members:
+            stat = os.stat(self.member_path(member))
+            digest.update(('%s\0%d\0%d\0' % (member, stat.st_size,\
+                stat.st_mtime_ns)).encode())
+        return digest.hexdigest()
+
+    def close(self):
+        pass
+
+#A backup in the older ZIP format, read in place
+class BackupZip(Backup):
+    def __init__(self, path):
+        self.path = path
+        self.archive = zipfile.ZipFile(path)
+        #dict mapping member names to names in the archive
+        self.members = dict()
+        for info in self.archive.infolist():
+            if not info.is_dir():
+                self.members[normalize_member(info.filename)] = info.filename
+
+    def open(self, member):
+        return self.archive.open(self.members[member])
+
+    def has_member(self, member):
+        return member in self.members
+
+    def size(self, member):
+        return self.archive.getinfo(self.members[member]).file_size
+
+    def blobs(self):
+        for member in self.members:
+            hash = blob_hash(member)
+            if hash is not None:
+                yield hash, member
+
+    #Archive members can only be copied
+    def copy_member(self, member, path, link_mode = LINK_COPY,\
+            verifier = None):
+        with self.open(member) as fin, open(path, 'wb') as fout:
+            if verifier is not None:
+                return verifier.copy(fin, fout)
+            shutil.copyfileobj(fin, fout)
+
+    def close(self):
+        self.archive.close()
+
+#A backup in the newer tar.gz format, read in place
+#A compressed tar can only be read front to back, so it is read twice:
+#once up front, keeping the (comparatively small) XML members in memory,
+#and once while iterating through the blobs, which can only be read
+#while they are the current member of that pass
+class BackupTar(Backup):
+    random_access = False
+
+    def __init__(self, path):
+        self.path = path
+        #dict mapping XML member names to their contents, or for those
+        #bigger than XML_SPOOL_SIZE (e.g. files.xml and questions.xml),
+        #None, in which case they're kept in a temporary directory, so
+        #that they can be parsed a bit at a time like any others
+        self.xml = dict()
+        self.spool = None
+        #The blob currently available during blobs(), as (member, file,
+        #size)
+        self.current = None
+        with tarfile.open(path, 'r|*') as archive:
+            for info in archive:
+                member = normalize_member(info.name)
+                if not info.isfile() or not member.endswith('.xml'):
+                    continue
+                fin = archive.extractfile(info)
+                if info.size <= XML_SPOOL_SIZE:
+                    self.xml[member] = fin.read()
+                    continue
+                if self.spool is None:
+                    self.spool = tempfile.TemporaryDirectory(\
+                        prefix = TEMP_PREFIX)
+                with open(self.spool_path(member), 'wb') as fout:
+                    shutil.copyfileobj(fin, fout, COPY_CHUNK_SIZE)
+                self.xml[member] = None
+
+    #Where a (big) XML member is kept
+    def spool_path(self, member):
+        return os.path.join(self.spool.name,\
+            urllib.parse.quote(member, safe = ''))
+
+    def open(self, member):
+        if member in self.xml:
+            if self.xml[member] is None:
+                return open(self.spool_path(member), 'rb')
+            return io.BytesIO(self.xml[member])
+        if self.current is not None and self.current[0] == member:
+            return self.current[1]
+        raise ValueError("Member %s cannot be read out of order" % member)
+
+    def size(self, member):
+        if member in self.xml:
+            if self.xml[member] is None:
+                return os.path.getsize(self.spool_path(member))
+            return len(self.xml[member])
+        if self.current is not None and self.current[0] == member:
+            return self.current[2]
+        raise ValueError("Member %s cannot be read out of order" % member)
+
+    def blobs(self):
+        with tarfile.open(self.path, 'r|*') as archive:
+            for info in archive:
+                member = normalize_member(info.name)
+                hash = blob_hash(member)
+                if info.isfile() and hash is not None:
+                    self.current = (member, archive.extractfile(info),\
+                        info.size)
+                    yield hash, member
+            self.current = None
+
+    #The blobs can't be gone to directly, so pick them out of a pass
+    def find_blobs(self, hashes):
+        wanted = set(hashes)
+        for hash, member in self.blobs():
+            if hash in wanted:
+                wanted.discard(hash)
+                yield hash, member
+
+    #Archive members can only be copied
+    def copy_member(self, member, path, link_mode = LINK_COPY,\
+            verifier = None):
+        with self.open(member) as fin, open(path, 'wb') as fout:
+            if verifier is not None:
+                return verifier.copy(fin, fout)
+            shutil.copyfileobj(fin, fout)
+
+    def close(self):
+        self.xml.clear()
+        if self.spool is not None:
+            self.spool.cleanup()
+            self.spool = None
+
+#Open the backup at path, which is either a directory or an .mbz file
+def open_backup(path):
+    if os.path.isdir(path):
+        return BackupDirectory(path)
+    if zipfile.is_zipfile(path):
+        return BackupZip(path)
+    if tarfile.is_tarfile(path):
+        return BackupTar(path)
+    raise ValueError("%s is neither a directory nor a backup file" % path)
 
 #Class representing files in the Moodle system
 #Used to track when a file has been located
 #Supports multiple names (aliases) and multiple contexts
+#There can be millions of these, so they're kept small: slots instead of
+#a dict of attributes, and tuples (almost always of one) instead of
+#dicts and sets
 class MoodleFile:
+    __slots__ = ('hash', 'aliases', 'new_names', 'context_ids', 'backup',\
+        'member', 'paths')
+
     def __init__(self, hash, name, context_id):
-        #dict mapping original names to names
-        self.names = {name : name}
-        self.initial_name = name
-        # self.id = id
         self.hash = hash
-        self.context_ids = {context_id}
-        self.dir = None
-
-    #Add another context ID
-    def add_context(self, context_id):
-        self.context_ids.add(context_id)
+        #Original names, the first of which is its initial name
+        self.aliases = (name,)
+        #The names it's given, one for each alias, once they've been
+        #chosen (see assign_paths)
+        self.new_names = None
+        self.context_ids = (context_id,)
+        self.backup = None
+        self.member = None
+        #The paths the file is copied to, one for each alias
+        self.paths = None
 
-    #Add an alias
-    def add_name(self, name):
-        self.names[name] = name
+    #The name the file is given in place of one of its aliases
+    def new_name(self, alias):
+        if self.new_names is None:
+            return alias
+        return self.new_names[self.aliases.index(alias)]
 
     #Call this once you've located the file
-    #dir is the directory it's located in
-    def locate(self, dir):
-        self.dir = dir
+    #member is where it's located in the backup
+    def locate(self, backup, member):
+        self.backup = backup
+        self.member = member
 
     #Has the file been located?
     def located(self):
-        return self.dir is not None
+        return self.member is not None
+
+    #Choose the paths to copy the file to, one for each of its names,
+    #avoiding collisions with the files created so far by this run
+    #Choosing paths up front, in a fixed order, keeps them from depending
+    #on the order the copies happen in
+    def assign_paths(self, destination):
+        self.paths = tuple(content_created.allocate(os.path.join(\
+            destination, NEW_FILES_DIR, alias)) for alias in self.aliases)
+        self.new_names = tuple(os.path.basename(path) for path in self.paths)
 
-    #Copy the file to its new location
-    def copy_over(self, destination):
+    #The backup isn't needed (or picklable) in worker processes
+    def __getstate__(self):
+        return {slot : getattr(self, slot) for slot in self.__slots__\
+            if slot != 'backup'}
+
+    def __setstate__(self, state):
+        self.backup = None
+        for slot, value in state.items():
+            setattr(self, slot, value)
+
+    #Copy (or link) the file to its new location
+    #If a manifest is given, a file it says was copied from a different
+    #blob is replaced, and the copy is recorded in it
+    #If a BlobStore is given, the file is put in it, and linked to from
+    #its new location instead
+    #If a Verifier is given, the blob is checked against its hash as it's
+    #read (if it's read at all)
+    #Returns the paths copies were made at (none if they all existed
+    #already), in order
+    def copy_over(self, destination, link_mode = LINK_COPY, manifest = None,\
+            store = None, verifier = None):
         #Fail if file has not been located
         if not self.located():
             raise ValueError("File %s not found" % self.hash)
-        for old_name in self.names:
-            name = self.names[old_name]
-            #Check for duplicates and make the copy
-            new_name = os.path.join(destination, NEW_FILES_DIR, name)
-            #In order to do this well, need to track where the file suffix is
-            dot_index = name.rfind(".")
-            if dot_index == -1:
-                dot_index = len(name)
-            else:
-                dot_index -= len(name)
-            changed = False
-            while new_name in content_created:
-                changed = True
-                #Update both the file's name and the path being written
-                new_name = new_name[:dot_index] + DUPLICATE_PROTECTION_SUFFIX\
-                    + new_name[dot_index:]
-                name = name[:dot_index] + DUPLICATE_PROTECTION_SUFFIX\
-                    + name[dot_index:]
-            if changed:
-                #Update the name in self.names
-                self.names[old_name] = name
-            #Register as a created file, to prevent collisions
-            content_created.add(new_name)
+        if self.paths is None:
+            self.assign_paths(destination)
+        created = []
+        #Where to make copies for the rest of the names from, once the
+        #blob has been read
+        copied_path = None
+        for path in self.paths:
             #Actually do the copy
-            if os.path.exists(new_name):
-                #File already exists
-                return False
+            #(lexists, so that a dangling symlink still counts as existing)
+            if os.path.lexists(path):
+                entry = manifest.get(path) if manifest is not None else None
+                if entry is None or entry['hash'] == self.hash:
+                    #File already exists
+                    continue
+                #Out of date, so replace it
+                os.remove(path)
+            #Copy the file
+            with atomic_path(path) as temp:
+                if copied_path is not None:
+                    link_file(copied_path, temp, link_mode)
+                elif store is not None:
+                    #(A blob that fails verification isn't stored, and
+                    #is copied to temp instead)
+                    copied_path = store.put(self, verifier, temp)
+                    if copied_path is not None:
+                        link_file(copied_path, temp, link_mode)
+                else:
+                    digest = self.backup.copy_member(self.member, temp,\
+                        link_mode, verifier)
+                    if verifier is not None:
+                        verifier.check(self, digest)
+            if copied_path is None:
+                copied_path = path
+            if manifest is not None:
+                manifest.record(path, {'hash' : self.hash,
+                    'source' : self.member})
+            created.append(path)
+        return created
+
+#Builds MoodleFiles up from the entries for them, one name and context
+#at a time
+#A file's names and contexts are only collected (in dicts, which keep
+#them in order) once it's been seen twice, and are only made into its
+#tuples by files(), so that a file with many of them doesn't take
+#quadratic time
+class FileCollector:
+    def __init__(self):
+        self.moodle_files = dict()
+        #Maps hashes of files seen more than once to (names, contexts)
+        self.extras = dict()
+
+    def add(self, hash, name, context_id):
+        file = self.moodle_files.get(hash)
+        if file is None:
+            self.moodle_files[hash] = MoodleFile(hash, name, context_id)
+            return
+        extras = self.extras.get(hash)
+        if extras is None:
+            extras = self.extras[hash] = (dict.fromkeys(file.aliases),\
+                dict.fromkeys(file.context_ids))
+        extras[0][name] = None
+        extras[1][context_id] = None
+
+    #The files collected, in a dict mapping hashes to MoodleFiles
+    def files(self):
+        for hash, (names, context_ids) in self.extras.items():
+            self.moodle_files[hash].aliases = tuple(names)
+            self.moodle_files[hash].context_ids = tuple(context_ids)
+        self.extras.clear()
+        return self.moodle_files
+
+#Checks that blobs match the SHA-1 hashes (contenthashes) they're named
+#by, hashing each one as it's copied, so that it's only read once
+#The hashing is done on a pool of threads (hashlib lets other threads
+#run while it hashes), so that it overlaps with reading and writing the
+#next chunk, and with the other copies
+class Verifier:
+    def __init__(self, jobs = 1):
+        self.pool = concurrent.futures.ThreadPoolExecutor(jobs)
+        #How many blobs have been checked
+        self.verified = 0
+        #The files whose blobs didn't match, and what they hashed to
+        self.mismatched = []
+        #The files missing from the backup
+        self.missing = []
+        self.lock = threading.Lock()
+
+    #Copy fin to fout (or just read it, if fout is None) in chunks,
+    #hashing the data on the way through
+    #Returns the hex digest of the data
+    def copy(self, fin, fout = None):
+        digest = hashlib.sha1()
+        update = None
+        while chunk := fin.read(VERIFY_CHUNK_SIZE):
+            if fout is not None:
+                fout.write(chunk)
+            #Chunks have to be hashed in order
+            if update is not None:
+                update.result()
+            update = self.pool.submit(digest.update, chunk)
+        if update is not None:
+            update.result()
+        return digest.hexdigest()
+
+    #Note the digest of a file's blob (see copy)
+    def check(self, file, digest):
+        with self.lock:
+            self.verified += 1
+            if digest != file.hash:
+                self.mismatched.append((file, digest))
+
+    #Note that a file is missing from the backup
+    def add_missing(self, file):
+        with self.lock:
+            self.missing.append(file)
+
+    #What's been found, as a dict
+    def report(self):
+        return {'verified' : self.verified,\
+            'mismatched' : [{'name' : file.aliases[0], 'hash' : file.hash,\
+            'actual' : digest} for file, digest in self.mismatched],\
+            'missing' : [{'name' : file.aliases[0], 'hash' : file.hash}\
+            for file in self.missing]}
+
+    def close(self):
+        self.pool.shutdown()
+
+#A content-addressed store of blobs, shared between several backups so
+#that files common to them are only stored once
+#Laid out like the files directory of a backup
+class BlobStore:
+    def __init__(self, path):
+        self.path = path
+        #Bytes of blobs written to the store, and found there already
+        self.written_bytes = 0
+        self.reused_bytes = 0
+        #Hashes of the blobs in the store known to match them
+        self.verified = set()
+        self.lock = threading.Lock()
+
+    #Put a located file's blob in the store, unless it's there already
+    #If a Verifier is given, the blob is checked as it's copied, and a
+    #blob that's there already is checked (once) before it's used
+    #A blob that doesn't match its hash is never stored: it's moved to
+    #mismatch_path instead, if that's given, and None is returned
+    #Otherwise, returns the path to the blob in the store
+    def put(self, file, verifier = None, mismatch_path = None):
+        path = os.path.join(self.path, file.hash[:2], file.hash)
+        damaged = False
+        if os.path.exists(path):
+            if verifier is not None and file.hash not in self.verified:
+                #It may have been stored without being checked, or
+                #damaged since
+                with open(path, 'rb') as fin:
+                    damaged = verifier.copy(fin) != file.hash
+            if not damaged:
+                with self.lock:
+                    if verifier is not None:
+                        verifier.check(file, file.hash)
+                        self.verified.add(file.hash)
+                    self.reused_bytes += os.path.getsize(path)
+                return path
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok = True)
+        #Copy to a temporary file first, so that the blob only appears
+        #once it's complete, and only once if others are storing it too
+        temp = temp_path(path)
+        digest = file.backup.copy_member(file.member, temp,\
+            verifier = verifier)
+        if verifier is not None:
+            verifier.check(file, digest)
+            if digest != file.hash:
+                if mismatch_path is not None:
+                    os.replace(temp, mismatch_path)
+                else:
+                    os.remove(temp)
+                return None
+        size = os.path.getsize(temp)
+        if damaged:
+            #Replace the damaged blob with the good one
+            os.replace(temp, path)
+            written = True
+        else:
+            try:
+                os.link(temp, path)
+                written = True
+            except FileExistsError:
+                written = False
+            except OSError:
+                #No hard links here, so settle for replacing
+                os.replace(temp, path)
+                written = True
+        if os.path.exists(temp):
+            os.remove(temp)
+        with self.lock:
+            if verifier is not None:
+                self.verified.add(file.hash)
+            if written:
+                self.written_bytes += size
             else:
-                #Copy the file
-                shutil.copyfile(os.path.join(self.dir, self.hash), new_name)
-                return True
+                self.reused_bytes += size
+        return path
+
+#Locate the given files (a dict mapping hashes to MoodleFiles) in the
+#backup and copy them over to destination
+#Runs up to jobs copies at once, if the backup can be read out of order
+#Yields (file, created) pairs for the located files, in a fixed order,
+#where created is the paths copies were made at (see
+#MoodleFile.copy_over)
+def copy_files(backup, files, destination, jobs = 1, link_mode = LINK_COPY,
+        manifest = None, store = None, verifier = None):
+    #Choose every path first, in files.xml order
+    for file in files.values():
+        file.assign_paths(destination)
+    if jobs > 1 and backup.random_access:
+        with concurrent.futures.ThreadPoolExecutor(jobs) as pool:
+            copies = []
+            for hash, member in backup.find_blobs(list(files)):
+                file = files[hash]
+                file.locate(backup, member)
+                copies.append((file, pool.submit(file.copy_over,
+                    destination, link_mode, manifest, store, verifier)))
+            for file, copy in copies:
+                yield file, copy.result()
+    else:
+        for hash, member in backup.find_blobs(list(files)):
+            file = files[hash]
+            file.locate(backup, member)
+            yield file, file.copy_over(destination, link_mode, manifest,\
+                store, verifier)
+
+#The tarfile mode to write an archive at path in, or None for a ZIP file,
+#going by its extension (see ARCHIVE_FORMATS)
+def archive_mode(path):
+    for extension, mode in ARCHIVE_FORMATS.items():
+        if path.lower().endswith(extension):
+            return mode
+    raise ValueError("%s is not a supported kind of archive" % path)
+
+#The name of the member of an archive for a path relative to its root
+def archive_member(path):
+    return path.replace(os.sep, '/')
+
+#Output written into a single ZIP or tar file (see ARCHIVE_FORMATS), laid
+#out like a destination directory, instead of as many separate files
+#Members are added as they're produced, and tar files are written as a
+#stream, so nothing is ever read back
+class ArchiveWriter:
+    def __init__(self, path):
+        self.zip = None
+        self.tar = None
+        mode = archive_mode(path)
+        if mode is None:
+            self.zip = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED)
+        else:
+            self.tar = tarfile.open(path, mode)
+
+    #Add a member, reading its data (size bytes of it) from fin in chunks
+    #Pass compress = False for data that's likely compressed already
+    #(which tar files, being compressed as a whole, ignore)
+    def add_file(self, member, fin, size, compress = True):
+        if self.zip is not None:
+            info = zipfile.ZipInfo(member, time.localtime()[:6])
+            info.compress_type = zipfile.ZIP_DEFLATED if compress else\
+                zipfile.ZIP_STORED
+            with self.zip.open(info, 'w', force_zip64 =\
+                    size >= zipfile.ZIP64_LIMIT) as out:
+                shutil.copyfileobj(fin, out, COPY_CHUNK_SIZE)
+        else:
+            info = tarfile.TarInfo(member)
+            info.size = size
+            info.mtime = time.time()
+            self.tar.addfile(info, fin)
+
+    #Add a member, given its data
+    def add_bytes(self, member, data):
+        self.add_file(member, io.BytesIO(data), len(data))
+
+    #Add a located file (a MoodleFile) under each of its names, which
+    #must have been chosen by assign_paths relative to the archive's root
+    #Its blob is only read once if possible; in a tar file, the rest of
+    #its names are hard links to the first
+    def add_moodle_file(self, file):
+        members = [archive_member(path) for path in file.paths]
+        size = file.backup.size(file.member)
+        if self.zip is not None and len(members) > 1 and\
+                not file.backup.random_access:
+            #The blob can only be read once, so keep it to hand
+            with tempfile.TemporaryFile() as spool:
+                with file.backup.open(file.member) as fin:
+                    shutil.copyfileobj(fin, spool, COPY_CHUNK_SIZE)
+                for member in members:
+                    spool.seek(0)
+                    self.add_file(member, spool, size, False)
+            return
+        with file.backup.open(file.member) as fin:
+            self.add_file(members[0], fin, size, False)
+        for member in members[1:]:
+            if self.tar is not None:
+                info = tarfile.TarInfo(member)
+                info.type = tarfile.LNKTYPE
+                info.linkname = members[0]
+                info.mtime = time.time()
+                self.tar.addfile(info)
+            else:
+                with file.backup.open(file.member) as fin:
+                    self.add_file(member, fin, size, False)
+
+    def close(self):
+        if self.zip is not None:
+            self.zip.close()
+        else:
+            self.tar.close()
+
+#The files (as returned by load_files) in each context, in files.xml
+#order, for finding the ones an activity can refer to
+#Each context's files are kept as an array of their positions in a
+#single list of the files, rather than as a list of their own
+class ContextIndex:
+    def __init__(self, files):
+        self.files = list(files.values())
+        #dict mapping context IDs to arrays of positions in self.files
+        self.positions = dict()
+        for position, file in enumerate(self.files):
+            for context_id in file.context_ids:
+                if context_id not in self.positions:
+                    self.positions[context_id] = array.array('I')
+                self.positions[context_id].append(position)
+
+    #The located files in a context
+    def located(self, context_id):
+        return [self.files[position] for position in\
+            self.positions.get(context_id, ()) if\
+            self.files[position].located()]
+
+#Keeps track of which contexts have all of their files in place, for
+#rendering activities while files are still being copied
+#The files in each context are found with index (a ContextIndex, or
+#anything else with a located method, like a CatalogContextIndex), or by
+#default a ContextIndex of files
+class ContextTracker:
+    def __init__(self, files, index = None):
+        self.index = index if index is not None else ContextIndex(files)
+        #How many of each context's files have yet to be placed
+        self.waiting = collections.Counter()
+        for file in files.values():
+            for context_id in file.context_ids:
+                self.waiting[context_id] += 1
+        #Set once every file there is to place has been
+        self.done = False
+        self.condition = threading.Condition()
+
+    #Note that a (located) file has been placed
+    def placed(self, file):
+        with self.condition:
+            for context_id in file.context_ids:
+                self.waiting[context_id] -= 1
+            self.condition.notify_all()
+
+    #Note that all of the files have been placed, other than any missing
+    #from the backup
+    def finish(self):
+        with self.condition:
+            self.done = True
+            self.condition.notify_all()
+
+    #Have all of a context's files been placed?
+    def ready(self, context_id):
+        with self.condition:
+            return self.done or self.waiting[context_id] <= 0
+
+    #Wait until all of a context's files have been placed
+    def wait(self, context_id):
+        with self.condition:
+            self.condition.wait_for(lambda: self.done or\
+                self.waiting[context_id] <= 0)
+
+    #The located files in a context, in files.xml order, once it's ready
+    def context_files(self, context_id):
+        return self.index.located(context_id)
+
+#Record of what previous runs wrote to a destination, so that reruns
+#(e.g. on a newer backup of the same course) only redo what has changed
+#Maps each output path, relative to the destination, to a dict with
+#the hash of its content, the member of the backup it came from, and
+#for HTML pages, the activity's title, type, context and fingerprint
+#of its inputs (see activity_fingerprint), and digests of its questions
+#Problems reading it are reported to progress
+class Manifest:
+    def __init__(self, destination, progress = None):
+        if progress is None:
+            progress = Progress()
+        self.destination = destination
+        self.path = os.path.join(destination, MANIFEST_FILENAME)
+        self.outputs = dict()
+        if os.path.isfile(self.path):
+            try:
+                with open(self.path, 'r') as manifest_in:
+                    self.outputs = json.load(manifest_in)['outputs']
+            except (OSError, ValueError, KeyError):
+                progress.warning("Ignoring unreadable %s" %\
+                    MANIFEST_FILENAME, file = MANIFEST_FILENAME)
+        self.index_sources()
+        self.lock = threading.Lock()
+        #Where changes are journaled as they're made (see open_journal),
+        #and when it was last synced to disk
+        self.journal = None
+        self.synced = 0
+
+    #Note where each source's output was written last time
+    def index_sources(self):
+        self.sources = dict()
+        for key, entry in self.outputs.items():
+            self.sources[entry['source']] = key
+
+    #Start journaling changes as they're made, so that if the run is
+    #interrupted, the next one can pick up exactly where it left off
+    #If resume is true, the changes journaled by an interrupted run are
+    #kept (as if it had finished); otherwise they're discarded
+    def open_journal(self, resume = False):
+        journal_path = os.path.join(self.destination, JOURNAL_FILENAME)
+        if resume and os.path.isfile(journal_path):
+            with open(journal_path, 'r') as journal_in:
+                for line in journal_in:
+                    try:
+                        change = json.loads(line)
+                    except ValueError:
+                        #Cut off partway through, so that's the end
+                        break
+                    if change['entry'] is None:
+                        self.outputs.pop(change['key'], None)
+                    else:
+                        self.outputs[change['key']] = change['entry']
+            self.index_sources()
+            #Start the journal afresh from here
+            self.write()
+        self.journal = open(journal_path, 'w')
+        self.synced = time.monotonic()
+
+    #Journal a change to an output (None for its removal)
+    #Each change reaches the OS as soon as it's made, and the disk at
+    #least every CHECKPOINT_INTERVAL seconds
+    def log(self, key, entry):
+        if self.journal is None:
+            return
+        self.journal.write(json.dumps({'key' : key, 'entry' : entry},\
+            sort_keys = True) + '\n')
+        self.journal.flush()
+        if time.monotonic() - self.synced >= CHECKPOINT_INTERVAL:
+            os.fsync(self.journal.fileno())
+            self.synced = time.monotonic()
+
+    #How an output path is stored in the manifest
+    def key(self, path):
+        return os.path.relpath(path, self.destination).replace(os.sep, '/')
+
+    #The entry for an output path, or None
+    def get(self, path):
+        return self.outputs.get(self.key(path))
+
+    def record(self, path, entry):
+        with self.lock:
+            self.outputs[self.key(path)] = entry
+            self.log(self.key(path), entry)
+
+    def remove(self, path):
+        with self.lock:
+            self.outputs.pop(self.key(path), None)
+            self.log(self.key(path), None)
+
+    #The path the given source was written to by the last run, provided
+    #nothing else has been written there since; otherwise None
+    def previous_output(self, source):
+        key = self.sources.get(source)
+        entry = self.outputs.get(key)
+        if entry is None or entry['source'] != source:
+            return None
+        return os.path.join(self.destination, *key.split('/'))
+
+    #Write the manifest out (without the lock)
+    def write(self):
+        with atomic_path(self.path) as temp:
+            with open(temp, 'w') as manifest_out:
+                json.dump({'outputs' : self.outputs}, manifest_out,
+                    indent = 1, sort_keys = True)
+
+    #Save the manifest, once the run is over, after which the journal
+    #isn't needed
+    def save(self):
+        with self.lock:
+            self.write()
+            if self.journal is not None:
+                self.journal.close()
+                self.journal = None
+                os.remove(os.path.join(self.destination, JOURNAL_FILENAME))
+
+#A digest of a question (as returned by parse_question)
+def question_digest(question):
+    return hashlib.sha1(json.dumps(question, sort_keys = True).encode()).\
+        hexdigest()
+
+#A fingerprint of everything an activity's page is made from, other than
+#its questions: its XML, and the files in its context and their names
+def activity_fingerprint(axml, context_files):
+    digest = hashlib.sha1(axml)
+    for file in context_files:
+        for old_name, name in zip(file.aliases, file.new_names or\
+                file.aliases):
+            digest.update(('\0%s\0%s\0%s' % (file.hash, old_name,\
+                name)).encode())
+    return digest.hexdigest()
+
+#If the page for the activity with the given XML (a member of the backup)
+#is up to date according to the manifest, return its path, otherwise None
+#context_files are the located files in the activity's context (the
+#fingerprint covers its XML, so its context can't have changed if the
+#page is up to date)
+def unchanged_activity(manifest, amember, axml, context_files, questions):
+    path = manifest.previous_output(amember)
+    if path is None or not os.path.exists(path):
+        return None
+    entry = manifest.get(path)
+    if entry['inputs'] != activity_fingerprint(axml, context_files):
+        return None
+    for question_id, digest in entry['questions'].items():
+        if question_id not in questions or\
+                question_digest(questions[question_id]) != digest:
+            return None
+    return path
+
+#Index the given files by each of their (original) names
+def index_files(context_files):
+    aliases = dict()
+    for file in context_files:
+        for name in file.aliases:
+            #The first file with a given name wins
+            aliases.setdefault(name, file)
+    return aliases
+
+#Work out the name of the file a @@PLUGINFILE@@ URL refers to
+def plugin_file_name(url):
+    #Drop any query string or fragment (whatever.ext?stuff), before
+    #unquoting so that encoded ?s and #s in the name are left alone
+    for separator in '?#':
+        url = url.split(separator, 1)[0]
+    return urllib.parse.unquote(url)
+
+#Where a file is linked to from an HTML page, whose files are in files_dir
+#(relative to the page)
+def file_link(file, name, files_dir = NEW_FILES_DIR):
+    return urllib.parse.quote(posixpath.join(files_dir, file.new_name(name)))
 
 #Convert the given info into an HTML page
-def make_html(aname, content, context_files = []):
+#aliases is index_files(context_files), if it's already been computed
+#Files are linked to in files_dir (see file_link)
+def make_html(aname, content, context_files = [], aliases = None,\
+        files_dir = NEW_FILES_DIR):
     body = html.unescape(content)
-    #Find embedded files and fix them up
-    embedded_indices = set()
-    while (index := body.find(MOODLE_PLUGIN_FILE)) != -1:
-        #Get the file name
-        findex = index + len(MOODLE_PLUGIN_FILE)
-        quote_index = body.find('"', findex)
-        #Unqoute the URL for the filename
-        filename = urllib.parse.unquote(body[findex:quote_index])
-        #Clean up the filename, in case it's of the form whatever.ext?stuff
-        dot_index = filename.rfind('.')
-        qmark_index = filename.rfind('?')
-        if dot_index >= 0 and qmark_index > dot_index:
-            #Truncate the filename
-            filename = filename[:qmark_index]
-            quote_index = body.rfind('?', qmark_index)
+    if aliases is None:
+        aliases = index_files(context_files)
+    #Find embedded files and fix them up, all in one pass
+    embedded = set()
+    def replace_plugin_file(match):
+        filename = plugin_file_name(match.group(1))
+        #Files in subfolders are referred to by path
+        if filename not in aliases:
+            filename = filename[filename.rfind('/') + 1:]
         #Figure out which file it is
-        found = False
-        for i in range(len(context_files)):
-            if filename in context_files[i].names:
-                #Found it!
-                embedded_indices.add(i)
-                #Replace the given urllibbit with a reference to the file
-                body = body[:index] + os.path.join(NEW_FILES_DIR,\
-                    context_files[i].names[filename]) + body[quote_index:]
-                found = True
-                break
-        if not found:
+        if filename not in aliases:
             raise ValueError("File %s not found" % filename)
+        file = aliases[filename]
+        embedded.add(file.hash)
+        #Replace the URL with a reference to the file
+        return file_link(file, filename, files_dir)
+    parts = [PLUGIN_FILE_PATTERN.sub(replace_plugin_file, body)]
     #Append extra files as links
-    links_started = False
-    for i in range(len(context_files)):
-        if not i in embedded_indices:
-            #Add a link to this file
-            if not links_started:
-                links_started = True
-                body += '<ul>'
-            file = context_files[i]
-            body += '\n<li><a href="%s">%s</a></li>' %\
-                (os.path.join(NEW_FILES_DIR, file.names[file.initial_name]),\
-                    file.initial_name)
-    if links_started:
-        body += '\n</ul>'
+    links = ['\n<li><a href="%s">%s</a></li>' %\
+        (file_link(file, file.aliases[0], files_dir), file.aliases[0])\
+        for file in context_files if file.hash not in embedded]
+    if links:
+        parts.append('<ul>')
+        parts += links
+        parts.append('\n</ul>')
+    body = ''.join(parts)
     #Now, mess with the head
     head = "<title>%s</title>" % aname
     #Check for latex in body
@@ -185,38 +1323,109 @@ def make_html(aname, content, context_files = []):
     return "<html>\n<head>%s</head>\n<body>%s</body>\n</html>" %\
         (head, body)
 
-#Write an html file
-def write_html(dest, name, type, content):
-    #The HTML directory
-    dir = os.path.join(dest, NEW_HTML_DIR)
-    #Helpers for piecing together the file name and path
-    def compile_fname():
-        return "%s_%s.html" % (type, name)
-    def compile_fpath():
-        return os.path.join(dir, compile_fname())
+#Choose the path to write the page for an activity to, avoiding
+#collisions with the pages created so far by this run
+def html_path(dest, name, type):
     #If have pathvalidate, sanitize the name
     if HAS_PATHVALIDATE:
         name = pathvalidate.sanitize_filename(name)
-    #Continually rename while the file already exists
-    while compile_fpath() in html_created:
-        name += DUPLICATE_PROTECTION_SUFFIX
-    #This it the path we're going to work with
-    path = compile_fpath()
+    #Register the file, renamed if it already exists
+    return html_created.allocate(os.path.join(dest, NEW_HTML_DIR,\
+        "%s_%s.html" % (type, name)))
+
+#Write an html file to a path chosen by html_path
+#An existing file is left alone, unless replace is true
+def write_html_path(path, content, replace = False):
     #Does the file already exist?
-    if os.path.exists(path):
+    if os.path.exists(path) and not replace:
         #Code for already exists
         return FILE_EXISTS
-    #Register the file
-    html_created.add(path)
     #Write the file
     try:
-        with open(path, 'w') as out:
-            out.write(content)
+        with atomic_path(path) as temp:
+            with open(temp, 'w') as out:
+                out.write(content)
         return SUCCESS
     except:
-        print("Failed to write file %s" % compile_fname())
         return FAILURE
 
+#Record a page written to path in the manifest, with the info in entry,
+#cleaning up after its source if it was written elsewhere last time
+def record_html(manifest, path, entry):
+    previous = manifest.previous_output(entry.get('source'))
+    if previous is not None and previous != path:
+        if os.path.exists(previous) and previous not in html_created:
+            os.remove(previous)
+        manifest.remove(previous)
+    manifest.record(path, entry)
+
+#Find the title of an HTML page written by write_html_path, by reading it
+#Returns None if it doesn't have one
+def read_title(path):
+    with open(path, 'r') as html_in:
+        content = html_in.read()
+    title_index = content.find('<title>')
+    title_index_2 = content.find('</title>')
+    if title_index == -1 or title_index_2 == -1 or\
+            title_index_2 < title_index:
+        return None
+    return content[title_index + 7 : title_index_2]
+
+#Catalog the activity pages in html_dir, for the index
+#Returns a dict mapping activity types to lists of (file name, title)
+#The type and title of each page come from the manifest, so only pages
+#it doesn't know about are opened
+def catalog_pages(html_dir, manifest):
+    index = dict()
+    for html_file in os.listdir(html_dir):
+        #Check if HTML file
+        if html_file[-5:] != '.html':
+            continue
+        entry = manifest.get(os.path.join(html_dir, html_file))
+        if entry is not None and 'title' in entry:
+            type = entry['type']
+            title = entry['title']
+        else:
+            #Find its title and type
+            underscore_index = html_file.find('_')
+            if underscore_index == -1:
+                #What's this file doing here?
+                continue
+            type = html_file[:underscore_index]
+            if type not in ACTIVITY_NAMES:
+                #What's this file doing here?
+                continue
+            title = read_title(os.path.join(html_dir, html_file))
+            if title is None:
+                #What's this file doing here?
+                continue
+        #Add the file to the index
+        if ACTIVITY_NAMES[type] not in index:
+            index[ACTIVITY_NAMES[type]] = []
+        index[ACTIVITY_NAMES[type]].append((html_file, title))
+    return index
+
+#Make the HTML index for a course, given its name and its pages
+#(as returned by catalog_pages)
+def make_index(course_name, index):
+    #Start creating the content
+    content = ['<html><head><title>']
+    content.append('Index for %s</title></head><body><h1>Index for %s</h1>' %\
+        (course_name, course_name))
+    #Process the index in sorted order
+    types = list(index.keys())
+    types.sort()
+    for type in types:
+        content.append('<h2>%s</h2><ul>' % type)
+        #Process the files in order
+        entries = sorted(index[type], key = lambda entry:\
+            natural_keys(entry[0]))
+        for entry in entries:
+            content.append('\n<li><a href="%s">%s</a></li>' % entry)
+        content.append('</ul>')
+    content.append('</body></html>')
+    return ''.join(content)
+
 #Return a string representation of flt as a percentage to at most 2 places
 def percentify(flt):
     return ('%.2f' % (flt * 100)).rstrip('0').rstrip('.') + '%'
@@ -237,28 +1446,1119 @@ def pointify(flt):
     else:
         return num + ' points'
 
-if __name__ == '__main__':
-    #Get arguments
-    if len(sys.argv) < 2:
-        print("Usage: python3 moodle_backup_organize.py source [dest] "
-            "[--reset]")
-        sys.exit(0)
+#Iterate through the elements at the given path (a list of tags, from
+#the root's children down) in the XML file fin, without ever holding more
+#of the file in memory than one such element
+#Elements with the same tag elsewhere (e.g. nested inside the ones
+#wanted) are left alone
+#Each element is cleared and detached from its parent once the caller is
+#done with it, as is everything else down to the same depth
+def iter_elements(fin, path):
+    depth = len(path)
+    #The elements open, from the root down
+    stack = []
+    for event, element in etree.iterparse(fin, events=('start', 'end')):
+        if event == 'start':
+            stack.append(element)
+            continue
+        stack.pop()
+        if not stack or len(stack) > depth:
+            #The root, or inside an element still wanted
+            continue
+        if len(stack) == depth and element.tag == path[-1] and\
+                all(stack[i].tag == tag for i, tag in\
+                enumerate(path[:-1], 1)):
+            yield element
+        element.clear()
+        #It's the last of its parent's children, having just ended
+        del stack[-1][-1]
 
-    #Extract the source
-    source = sys.argv[1]
-    #Extract the destination
-    if len(sys.argv) >= 3 and not (len(sys.argv) == 3 and\
-            sys.argv[-1] == RESET_FLAG):
-        destination = sys.argv[2]
+#Read moodle_backup.xml from the backup
+#Returns the course's name, the activities node, and a dict mapping the
+#IDs of the course's sections to their titles
+def read_contents(backup):
+    with backup.open(CONTENT_XML) as xml_in:
+        croot = etree.parse(xml_in).getroot().find("information")
+    #Get the course name
+    try:
+        course_name = html.unescape(croot.find("original_course_fullname").\
+            text)
+    except:
+        course_name = "Moodle Site"
+    contents = croot.find("contents")
+    sections = dict()
+    if contents.find("sections") is not None:
+        for section in contents.find("sections"):
+            sections[section.findtext('sectionid')] =\
+                section.findtext('title')
+    return course_name, contents.find("activities"), sections
+
+#The section ID of each activity (the activities node of
+#moodle_backup.xml), as a dict mapping their members to them
+def activity_sections(croot):
+    return {activity_member(activity) : activity.findtext('sectionid')\
+        for activity in croot}
+
+#The member of the backup holding an activity's XML, given its node in
+#moodle_backup.xml
+def activity_member(activity):
+    return posixpath.join(activity.find('directory').text,\
+        "%s.xml" % activity.find('modulename').text)
+
+#Iterate through the activities (the activities node of moodle_backup.xml)
+#yielding (module name, member, XML) for each, read from the backup
+def read_activities(backup, croot):
+    for activity in croot:
+        amember = activity_member(activity)
+        with backup.open(amember) as ain:
+            yield activity.find('modulename').text, amember, ain.read()
+
+#Which activities to organize: those with the given module names (keys
+#of ACTIVITY_NAMES), with names matching the given regular expression
+#(anywhere in them), and in the given sections (by ID or title)
+#None for any of these means anything goes
+class ActivityFilter:
+    def __init__(self, mnames = None, pattern = None, sections = None):
+        self.mnames = set(mnames) if mnames is not None else None
+        self.pattern = re.compile(pattern) if pattern is not None else None
+        self.sections = set(sections) if sections is not None else None
+
+    #Does an activity pass, given its module name, name, and the ID and
+    #title of its section?
+    def selects(self, mname, aname, section_id, section_title):
+        if self.mnames is not None and mname not in self.mnames:
+            return False
+        if self.pattern is not None and\
+                (aname is None or self.pattern.search(aname) is None):
+            return False
+        if self.sections is not None and section_id not in self.sections\
+                and section_title not in self.sections:
+            return False
+        return True
+
+#Choose the activities to organize with an ActivityFilter, given
+#(module name, member, XML) for each activity, their sections (as
+#returned by activity_sections) and the course's (as by read_contents)
+#Returns the set of the chosen activities' members, and the set of
+#their context IDs
+def select_activities(activities, asections, sections, activity_filter):
+    members = set()
+    contexts = set()
+    for mname, amember, axml in activities:
+        aname, acontext = peek_activity(axml)
+        section_id = asections.get(amember)
+        if activity_filter.selects(mname, aname, section_id,\
+                sections.get(section_id)):
+            members.add(amember)
+            contexts.add(acontext)
+    return members, contexts
+
+#The files (as returned by load_files) in any of the given contexts
+def select_files(files, contexts):
+    return {hash : file for hash, file in files.items()\
+        if not contexts.isdisjoint(file.context_ids)}
+
+#Load the files from files.xml, given as an open file
+#Returns a dict mapping hashes to MoodleFiles
+def load_files(fin):
+    collector = FileCollector()
+    for file_entry in iter_elements(fin, FILE_PATH):
+        # #Get the file's ID
+        # id = file_entry.attrib['id']
+        #Get the file's hash, name, and context id
+        #(Names and context IDs are shared between many files, so only
+        #one copy of each is kept)
+        hash = file_entry.findtext('contenthash')
+        name = sys.intern(file_entry.findtext('filename'))
+        context_id = sys.intern(file_entry.findtext('contextid'))
+
+        #Add an entry for this file, or a new name and context if it's
+        #been found already
+        collector.add(hash, name, context_id)
+    return collector.files()
+
+#Extract the info about a question from its node
+#Returns a dict with its text, type, and (if applicable) template or answers
+def parse_question(question_node):
+    text = question_node.find('questiontext').text
+    type = question_node.find('qtype').text
+    #Store the info
+    question = {'text' : text, 'type' : type}
+
+    answer_node = question_node.find('plugin_qtype_%s_question' % type)
+    if answer_node is not None:
+        answers = answer_node.find('answers')
     else:
-        #If not given, use source as destination
-        destination = source
-    #Check for reset flag
-    if sys.argv[-1] == RESET_FLAG:
-        reset = True
+        answers = None
+    #Handle essays separately
+    if type == 'essay':
+        template = answer_node.find('essay').find('responsetemplate').text
+        if template is not None:
+            question['template'] = template
+    elif answers is not None:
+        question['answers'] = dict()
+        for answer in answers:
+            #Extract answer info
+            answer_id = answer.attrib['id']
+            answer_text = answer.find('answertext').text
+            answer_fraction = answer.find('fraction').text
+            answer_feedback = answer.find('feedback').text
+            #Store answer info
+            question['answers'][answer_id] = dict()
+            adict = question['answers'][answer_id]
+            adict['text'] = answer_text
+            adict['fraction'] = answer_fraction
+            if answer_feedback is not None:
+                adict['feedback'] = answer_feedback
+        #Special handling for numericals
+        if type == 'numerical':
+            #Units not currently handled
+            #Tolerance
+            records_node = answer_node.find('numerical_records')
+            for record_node in records_node:
+                ans_id = record_node.find('answer').text
+                tolerance = record_node.find('tolerance').text
+                if tolerance is not None:
+                    question['answers'][ans_id]['tolerance'] = tolerance
+    return question
+
+#Load the questions from questions.xml, given as an open file
+#If question_ids (a set) is given, only those questions are loaded; the
+#rest are skipped over as they're read, without being parsed
+#Returns a dict mapping question IDs to question info (see parse_question)
+def load_questions(fin, question_ids = None):
+    questions = dict()
+    for question_node in iter_elements(fin, QUESTION_PATH):
+        question_id = question_node.attrib['id']
+        if question_ids is None or question_id in question_ids:
+            questions[question_id] = parse_question(question_node)
+    return questions
+
+#Look up a question in a catalog, given a connection to it
+#Returns the question's info, as parse_question would, or None if there's
+#no such question
+def select_question(connection, question_id):
+    row = connection.execute("SELECT type, text, template, has_answers "
+        "FROM questions WHERE id = ?", (question_id,)).fetchone()
+    if row is None:
+        return None
+    type, text, template, has_answers = row
+    question = {'text' : text, 'type' : type}
+    if template is not None:
+        question['template'] = template
+    if has_answers:
+        question['answers'] = dict()
+        for answer_id, text, fraction, feedback, tolerance in\
+                connection.execute("SELECT id, text, fraction, feedback, "
+                "tolerance FROM answers WHERE question_id = ? "
+                "ORDER BY position", (question_id,)):
+            answer = {'text' : text, 'fraction' : fraction}
+            if feedback is not None:
+                answer['feedback'] = feedback
+            if tolerance is not None:
+                answer['tolerance'] = tolerance
+            question['answers'][answer_id] = answer
+    return question
+
+#A catalog of a backup's XML, kept in an SQLite database at path, so
+#that it only has to be parsed once, and things can be looked up in it
+#quickly (see CATALOG_SCHEMA)
+#Rebuilt from the backup whenever its XML changes (see Backup.fingerprint)
+class Catalog:
+    def __init__(self, path, backup):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        if self.meta('version') != str(CATALOG_VERSION) or\
+                self.meta('fingerprint') != backup.fingerprint():
+            self.build(backup)
+
+    #A value from the meta table, or None if there's no such (valid) table
+    def meta(self, key):
+        try:
+            row = self.connection.execute("SELECT value FROM meta "
+                "WHERE key = ?", (key,)).fetchone()
+        except sqlite3.DatabaseError:
+            return None
+        return row[0] if row is not None else None
+
+    #Build the catalog afresh from the backup
+    def build(self, backup):
+        self.connection.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.connection = sqlite3.connect(self.path)
+        self.connection.executescript(CATALOG_SCHEMA)
+        with self.connection as db:
+            with backup.open(FILES_XML) as xml_in:
+                files = load_files(xml_in)
+            for position, file in enumerate(files.values()):
+                db.execute("INSERT INTO files VALUES (?, ?)",\
+                    (file.hash, position))
+                db.executemany("INSERT INTO aliases VALUES (?, ?, ?)",\
+                    [(file.hash, i, name) for i, name in\
+                    enumerate(file.aliases)])
+                db.executemany("INSERT INTO contexts VALUES (?, ?)",\
+                    [(file.hash, context_id) for context_id in\
+                    file.context_ids])
+            with backup.open(QUESTIONS_XML) as xml_in:
+                for question_node in iter_elements(xml_in,\
+                        QUESTION_PATH):
+                    question_id = question_node.attrib['id']
+                    question = parse_question(question_node)
+                    db.execute("INSERT INTO questions VALUES "
+                        "(?, ?, ?, ?, ?)", (question_id, question['type'],\
+                        question['text'], question.get('template'),\
+                        'answers' in question))
+                    db.executemany("INSERT INTO answers VALUES "
+                        "(?, ?, ?, ?, ?, ?, ?)", [(question_id, i,\
+                        answer_id, answer['text'], answer['fraction'],\
+                        answer.get('feedback'), answer.get('tolerance'))\
+                        for i, (answer_id, answer) in\
+                        enumerate(question.get('answers', {}).items())])
+            course_name, croot, sections = read_contents(backup)
+            db.executemany("INSERT INTO sections VALUES (?, ?)",\
+                sections.items())
+            asections = activity_sections(croot)
+            for position, (mname, amember, axml) in\
+                    enumerate(read_activities(backup, croot)):
+                aname, acontext = peek_activity(axml)
+                db.execute("INSERT INTO activities VALUES "
+                    "(?, ?, ?, ?, ?, ?, ?)", (position, mname, amember,\
+                    aname, acontext, asections[amember], axml))
+            #Only valid once everything else is there
+            db.executemany("INSERT INTO meta VALUES (?, ?)",\
+                [('course_name', course_name),\
+                ('version', str(CATALOG_VERSION)),\
+                ('fingerprint', backup.fingerprint())])
+
+    #The course's name
+    def course_name(self):
+        return self.meta('course_name')
+
+    #The files, as load_files would return them
+    def files(self):
+        context_ids = collections.defaultdict(list)
+        for hash, context_id in self.connection.execute("SELECT hash, "
+                "context_id FROM contexts"):
+            context_ids[hash].append(sys.intern(context_id))
+        #(Names and contexts were stored without duplicates, so they
+        #can be gathered in lists and made into tuples once at the end)
+        names = dict()
+        for hash, name in self.connection.execute("SELECT files.hash, name "
+                "FROM files JOIN aliases ON files.hash = aliases.hash "
+                "ORDER BY files.position, aliases.position"):
+            names.setdefault(hash, []).append(sys.intern(name))
+        files = dict()
+        for hash, file_names in names.items():
+            files[hash] = file = MoodleFile(hash, file_names[0],\
+                context_ids[hash][0])
+            if len(file_names) > 1:
+                file.aliases = tuple(file_names)
+            if len(context_ids[hash]) > 1:
+                file.context_ids = tuple(context_ids[hash])
+        return files
+
+    #The hashes of the files in a context, in files.xml order
+    def files_in_context(self, context_id):
+        return [row[0] for row in self.connection.execute("SELECT "
+            "files.hash FROM contexts JOIN files ON "
+            "files.hash = contexts.hash WHERE context_id = ? "
+            "ORDER BY files.position", (context_id,))]
+
+    #The questions, as load_questions would return them, but only looked
+    #up as they're needed (see CatalogQuestions)
+    def questions(self):
+        return CatalogQuestions(self.path)
+
+    #The course's sections, as read_contents returns them
+    def sections(self):
+        return dict(self.connection.execute("SELECT id, title "
+            "FROM sections"))
+
+    #The section ID of each activity, as activity_sections returns them
+    def activity_sections(self):
+        return dict(self.connection.execute("SELECT member, section "
+            "FROM activities"))
+
+    #Iterate through the activities, as read_activities does, optionally
+    #only those of the given module names
+    def activities(self, mnames = None):
+        query = "SELECT module, member, xml FROM activities"
+        if mnames is not None:
+            mnames = list(mnames)
+            query += " WHERE module IN (%s)" % ', '.join('?' * len(mnames))
+        for mname, amember, axml in self.connection.execute(query +\
+                " ORDER BY position", mnames or ()):
+            yield mname, amember, axml
+
+    def close(self):
+        self.connection.close()
+
+#The questions in the catalog at path, as a read-only dict mapping
+#question IDs to question info (see select_question)
+#Each is looked up the first time it's needed, and kept after that
+#Can be sent to worker processes, which open the catalog for themselves
+class CatalogQuestions(collections.abc.Mapping):
+    def __init__(self, path):
+        self.path = path
+        self.connection = None
+        self.questions = dict()
+
+    #The connection to the catalog, opened the first time it's needed
+    def connect(self):
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.path)
+        return self.connection
+
+    def __getitem__(self, question_id):
+        if question_id not in self.questions:
+            question = select_question(self.connect(), question_id)
+            if question is None:
+                raise KeyError(question_id)
+            self.questions[question_id] = question
+        return self.questions[question_id]
+
+    def __iter__(self):
+        return iter([row[0] for row in self.connect().execute("SELECT id "
+            "FROM questions ORDER BY rowid")])
+
+    def __len__(self):
+        return self.connect().execute("SELECT COUNT(*) FROM questions").\
+            fetchone()[0]
+
+    #Connections can't be sent between processes
+    def __getstate__(self):
+        return {'path' : self.path, 'connection' : None,\
+            'questions' : dict()}
+
+#The files (as returned by Catalog.files) in each context, looked up in
+#the catalog as they're needed, rather than indexed up front as by a
+#ContextIndex
+class CatalogContextIndex:
+    def __init__(self, catalog, files):
+        self.catalog = catalog
+        self.files = files
+
+    #The located files in a context
+    def located(self, context_id):
+        return [self.files[hash] for hash in\
+            self.catalog.files_in_context(context_id) if hash in\
+            self.files and self.files[hash].located()]
+
+#Render the given question (as returned by parse_question) as HTML
+#Covers everything but the heading, which depends on the quiz it's in
+def render_question(question):
+    question_type = question['type']
+    parts = []
+    #Throw in the text
+    parts.append('%s' % question['text'])
+    #Throw in template if it's there
+    if 'template' in question:
+        parts.append('<br>Template: %s<br>' % question['template'])
+    #Process answers
+    if 'answers' in question:
+        #Handle multichoice separately
+        if question_type == 'multichoice':
+            parts.append('<ol type="a">')
+        else:
+            parts.append('<ul>')
+        for answer_id in question['answers']:
+            answer = question['answers'][answer_id]
+            #Text
+            parts.append('<li>%s' % answer['text'])
+            #Tolerance
+            if 'tolerance' in answer:
+                parts.append(' +/- %s' % answer['tolerance'])
+            #Fraction
+            fraction = answer['fraction']
+            if fraction is not None:
+                #Format fraction as a two-decimal percent
+                parts.append(" (%s)" % percentify(float(fraction)))
+            #Feedback
+            if 'feedback' in answer:
+                parts.append('<br><br>Feedback: %s' % answer['feedback'])
+            #End list item
+            parts.append('</li>')
+        #End list
+        #Handle multichoice separately
+        if question_type == 'multichoice':
+            parts.append('</ol>')
+        else:
+            parts.append('</ul>')
+    #Add in extra spacing
+    parts.append('<br>\n')
+    return ''.join(parts)
+
+#The IDs of the questions used by a quiz, given its node in the
+#activity's XML
+def quiz_question_ids(achild):
+    return [question_node.find('questionid').text for question_node in\
+        achild.find('question_instances')]
+
+#The IDs of the questions used by the quizzes among the activities (the
+#activities node of moodle_backup.xml), read from their XML in the backup
+#If members (a set) is given, only the quizzes with those members count
+#Most of a question bank often isn't used by any quiz in the backup, so
+#this is what's worth loading (see load_questions)
+def used_question_ids(backup, croot, members = None):
+    question_ids = set()
+    for activity in croot:
+        mname = activity.find('modulename').text
+        amember = activity_member(activity)
+        if mname == QUIZ and (members is None or amember in members):
+            with backup.open(amember) as ain:
+                for question_id in iter_elements(ain,\
+                        QUIZ_QUESTION_ID_PATH):
+                    question_ids.add(question_id.text)
+    return question_ids
+
+#Render the content of a quiz, given its node in the activity's XML
+#questions is as returned by load_questions
+#Questions are often shared between many quizzes, so each is only
+#rendered once, and kept in rendered (a dict mapping question IDs to HTML)
+def render_quiz(achild, questions, rendered):
+    parts = []
+    #Get the intro content
+    aintro = achild.find('intro').text
+    if aintro is not None and len(aintro) > 0:
+        parts.append(aintro + '\n<br><br>\n')
+    #Process the questions
+    question_nodes = dict()
+    questions_node = achild.find('question_instances')
+    for question_node in questions_node:
+        #Get the ID, page, slot, and maxmark
+        question_id = question_node.find('questionid').text
+        page = int(question_node.find('page').text)
+        slot = int(question_node.find('slot').text)
+        points = question_node.find('maxmark').text
+        #Store for later sorting
+        question_nodes[(page, slot)] = {'id' : question_id,\
+            'points' : points}
+    #Process the questions in order
+    question_numbers = list(question_nodes.keys())
+    question_numbers.sort()
+    count = 1
+    for question_number in question_numbers:
+        #Re-extract the info
+        question_node = question_nodes[question_number]
+        question_id = question_node['id']
+        #Get the question record
+        question = questions[question_id]
+        #Treat descriptions specially
+        if question['type'] != 'description':
+            #Get the number of points
+            points = float(question_node['points'])
+            parts.append('<b>Question %d</b> (%s)<br>' % (count,\
+                pointify(points)))
+            #Throw in the type
+            parts.append('[%s]' % question['type'])
+            #Increment the question counter
+            count += 1
+        else:
+            parts.append('<b>Instructions:</b> ')
+        #Render the question itself, if it hasn't been already
+        if question_id not in rendered:
+            rendered[question_id] = render_question(question)
+        parts.append(rendered[question_id])
+    return ''.join(parts)
+
+#Get the name and context ID of an activity from its XML, stopping as
+#soon as they've been found
+def peek_activity(axml):
+    depth = 0
+    acontext = None
+    for event, element in etree.iterparse(io.BytesIO(axml),\
+            events = ('start', 'end')):
+        if event == 'start':
+            depth += 1
+            if depth == 1:
+                acontext = element.attrib['contextid']
+        else:
+            depth -= 1
+            #The name is a child of the module's node, under the root
+            if depth == 2 and element.tag == 'name':
+                return element.text, acontext
+    return None, acontext
+
+#What activities are rendered with, in each process (see init_worker)
+worker_state = dict()
+
+#Set up a process to render activities, given the questions (as returned
+#by load_questions) and a ContextIndex of the files, once they've been
+#located (unless they're to be sent along with each activity instead)
+#Pages link to files in files_dir, relative to the pages (see file_link)
+#Called once per worker process, so these are only sent over once each
+def init_worker(questions, context_index = None,\
+        files_dir = NEW_FILES_DIR):
+    worker_state['questions'] = questions
+    worker_state['context_index'] = context_index or ContextIndex(dict())
+    worker_state['files_dir'] = files_dir
+    #Questions rendered so far, shared between quizzes
+    worker_state['rendered_questions'] = dict()
+
+#The HTML content of an activity's page, given its node in the activity's
+#XML, before it's made into a page by make_html
+#Returns None if the type of activity isn't supported
+def activity_content(achild, mname, aname):
+    #Handle the various types
+    #Assignment, resource or folder
+    if mname == ASSIGNMENT or mname == RESOURCE or mname == FOLDER:
+        #Get the HTML content
+        acontent = achild.find('intro').text
+    #Page
+    elif mname == PAGE:
+        #Get the HTML content
+        aintro = achild.find('intro').text
+        acontent = achild.find('content').text
+        if aintro is not None and len(aintro) > 0:
+            acontent = aintro + "\n<br><br>\n" + acontent
+    #URL
+    elif mname == URL:
+        #Get the URL content
+        acontent = achild.find('externalurl').text
+        #Convert to html
+        acontent = '<a href="%s">%s</a>' % (acontent, aname)
+    #Quiz
+    elif mname == QUIZ:
+        acontent = render_quiz(achild, worker_state['questions'],\
+            worker_state['rendered_questions'])
+    #Other (ignore)
     else:
-        reset = False
+        return None
+    #Fix up/finalize the HTML
+    if acontent is None or len(acontent) == 0:
+        acontent = mname.capitalize()
+    return acontent
+
+#Render the page for an activity from its XML, and write it to path
+#(see write_html_path for replace)
+#The located files in its context can be given, or else are looked up
+#in the ones given to init_worker
+#Runs in a worker process, or this one, once init_worker has been called
+#Returns (status, manifest entry, error message)
+def render_activity(axml, mname, amember, path, replace,\
+        context_files = None):
+    questions = worker_state['questions']
+    #Get the root and the child we care about
+    aroot = etree.fromstring(axml)
+    achild = aroot.find(mname)
+
+    #Get the activity's name and context ID
+    aname = achild.find('name').text
+    acontext = aroot.attrib['contextid']
 
+    #Get the contextual files
+    if context_files is None:
+        context_files = worker_state['context_index'].located(acontext)
+
+    acontent = activity_content(achild, mname, aname)
+    if acontent is None:
+        #Report no copy
+        return UNSUPPORTED, None, None
+
+    #Actually try to do a write now
+    try:
+        html_content = make_html(aname, acontent, context_files,\
+            files_dir = worker_state['files_dir'])
+        #Do the write
+        success = write_html_path(path, html_content, replace)
+    except Exception as ex:
+        return FAILURE, None, str(ex)
+    if success == FAILURE:
+        return FAILURE, None, "Failed to write file %s" %\
+            os.path.basename(path)
+    #Record what went into it
+    entry = {'source' : amember, 'title' : aname, 'type' : mname,\
+        'context' : acontext,\
+        'inputs' : activity_fingerprint(axml, context_files),\
+        'questions' : dict(),\
+        'hash' : hashlib.sha1(html_content.encode()).hexdigest()}
+    if mname == QUIZ:
+        for question_id in quiz_question_ids(achild):
+            entry['questions'][question_id] =\
+                question_digest(questions[question_id])
+    return success, entry, None
+
+#Render an activity (see render_activity), timing how long it takes
+#Returns render_activity's result, plus the time taken in seconds
+def timed_render_activity(axml, mname, amember, path, replace,\
+        context_files = None):
+    start = time.perf_counter()
+    result = render_activity(axml, mname, amember, path, replace,\
+        context_files)
+    return result + (time.perf_counter() - start,)
+
+#Render the page for an activity from its XML, without writing it
+#Runs in a worker process, or this one, once init_worker has been called
+#Returns (status, the page's HTML or None, error message)
+def render_page(axml, mname):
+    aroot = etree.fromstring(axml)
+    achild = aroot.find(mname)
+    aname = achild.find('name').text
+    context_files = worker_state['context_index'].located(\
+        aroot.attrib['contextid'])
+    acontent = activity_content(achild, mname, aname)
+    if acontent is None:
+        return UNSUPPORTED, None, None
+    try:
+        return SUCCESS, make_html(aname, acontent, context_files,\
+            files_dir = worker_state['files_dir']), None
+    except Exception as ex:
+        return FAILURE, None, str(ex)
+
+#An already-finished result, to go alongside ones still being worked on
+def finished(result):
+    future = concurrent.futures.Future()
+    future.set_result(result)
+    return future
+
+#The wall clock and CPU time used so far, in seconds
+#CPU time includes that of finished child processes (e.g. a shut down
+#pool's workers), as well as all of this process's threads
+def clock():
+    times = os.times()
+    return time.perf_counter(), times.user + times.system +\
+        times.children_user + times.children_system
+
+#Timings and counts for a run of organize, for a report (see report)
+#If profile_path is given, the stage named profile_stage is run under
+#cProfile, and the profile dumped to profile_path
+class RunStats:
+    def __init__(self, profile_stage = None, profile_path = None):
+        self.profile_stage = profile_stage
+        self.profile_path = profile_path
+        #dict mapping stage names to their wall clock and CPU times
+        self.stages = dict()
+        #Copies of files made, and their total size in bytes
+        self.copies = 0
+        self.bytes_copied = 0
+        #How many activities ended up with each status
+        self.statuses = collections.Counter()
+        #(seconds, type, name) for each activity rendered
+        self.rendered = []
+        self.started = clock()
+
+    #Time the code run inside this, as the given stage
+    #If memory is being traced (with tracemalloc, e.g. by a benchmark),
+    #the peak memory allocated during the stage is recorded too
+    @contextlib.contextmanager
+    def stage(self, name):
+        profiler = None
+        if name == self.profile_stage and self.profile_path is not None:
+            profiler = cProfile.Profile()
+        tracing = tracemalloc.is_tracing() and\
+            hasattr(tracemalloc, 'reset_peak')
+        if tracing:
+            tracemalloc.reset_peak()
+        wall, cpu = clock()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                profiler.dump_stats(self.profile_path)
+            end_wall, end_cpu = clock()
+            self.stages[name] = {'wall' : end_wall - wall,\
+                'cpu' : end_cpu - cpu}
+            if tracing:
+                self.stages[name]['peak_bytes'] =\
+                    tracemalloc.get_traced_memory()[1]
+
+    #Count the copies made of a file, given the paths they were made at
+    #(see MoodleFile.copy_over)
+    #Returns the number of bytes copied
+    def add_copies(self, file, created):
+        if not created:
+            return 0
+        self.copies += len(created)
+        copied = len(created) * os.path.getsize(created[0])
+        self.bytes_copied += copied
+        return copied
+
+    #Count an activity's status, and how long it took to render (if
+    #it was rendered)
+    def add_activity(self, mname, aname, status, seconds):
+        self.statuses[STATUS_NAMES.get(status, STATUS_NAMES[UNKNOWN])] += 1
+        if seconds is not None:
+            self.rendered.append((seconds, mname, aname))
+
+    #Items per second of the given stage's wall clock time
+    def rate(self, count, stage):
+        wall = self.stages.get(stage, {'wall' : 0})['wall']
+        return count / wall if wall > 0 else None
+
+    #A dict of everything measured, ready to be written as JSON
+    #Anything in extra is included too
+    def report(self, extra = {}):
+        wall, cpu = clock()
+        report = {'stages' : self.stages,\
+            'total' : {'wall' : wall - self.started[0],\
+                'cpu' : cpu - self.started[1]},\
+            'copies' : self.copies, 'bytes_copied' : self.bytes_copied,\
+            'activities' : sum(self.statuses.values()),\
+            'statuses' : dict(self.statuses),\
+            'slowest_activities' : [{'type' : mname, 'name' : aname,\
+                'seconds' : seconds} for seconds, mname, aname in\
+                sorted(self.rendered, key = lambda activity:\
+                -activity[0])[:SLOWEST_ACTIVITIES]]}
+        report.update(extra)
+        report['files_per_second'] = self.rate(report.get('located', 0),\
+            STAGE_COPY)
+        report['activities_per_second'] = self.rate(report['activities'],\
+            STAGE_ACTIVITIES)
+        return report
+
+#A time left, in seconds, as m:ss
+def format_eta(seconds):
+    return '%d:%02d' % divmod(int(seconds), 60)
+
+#Describe how far a stage has got: done of total (if known) items,
+#counted in unit, and bytes written for them, in elapsed seconds
+#If final, it's how the stage went instead
+def describe_stage(name, unit, done, total, bytes, elapsed, final = False):
+    rate = done / elapsed if elapsed > 0 else 0
+    throughput = ['%.0f %s/s' % (rate, unit)]
+    if bytes:
+        throughput.append('%.1f MB/s' % (bytes / elapsed / 1e6\
+            if elapsed > 0 else 0))
+    if final:
+        return '%s: %d %s in %.1f s (%s)' % (name, done, unit, elapsed,\
+            ', '.join(throughput))
+    if total is None:
+        count = '%d %s' % (done, unit)
+    else:
+        count = '%d/%d %s (%d%%)' % (done, total, unit,\
+            100 * done // max(total, 1))
+    line = '%s: %s, %s' % (name, count, ', '.join(throughput))
+    if total is not None and rate > 0:
+        line += ', ETA %s' % format_eta((total - done) / rate)
+    return line
+
+#Reports on a run as it goes, to out (stdout by default)
+#Stages with many items (see start) get a line each, with counts,
+#throughput and an ETA, redrawn in place at most every PROGRESS_INTERVAL
+#seconds if out is a terminal, and otherwise only written once the
+#stage is done
+#Items are only reported on lines of their own at VERBOSE; at QUIET,
+#nothing is written but the failures, at the end (see close)
+#Everything can also be logged to the file at log_path, whatever the
+#verbosity, as text or JSON lines (see LOG_FORMATS), buffered so that
+#it's written in large chunks
+#Safe to share between threads
+class Progress:
+    def __init__(self, verbosity = NORMAL, log_path = None,\
+            log_format = LOG_TEXT, out = None):
+        self.verbosity = verbosity
+        self.out = out if out is not None else sys.stdout
+        self.live = verbosity > QUIET and hasattr(self.out, 'isatty') and\
+            self.out.isatty()
+        self.log = None
+        if log_path is not None:
+            self.log = open(log_path, 'w', buffering = LOG_BUFFER_SIZE)
+        self.log_format = log_format
+        #Are items reported anywhere? (If not, there's no need to
+        #describe them)
+        self.items = verbosity >= VERBOSE or self.log is not None
+        #Stages in progress, in the order they started, as dicts of their
+        #unit, items done and total, bytes and start time
+        self.stages = dict()
+        #Messages about failures, for the summary at the end
+        self.failures = []
+        #When the progress line was last drawn, and how long it was
+        self.drawn = 0
+        self.width = 0
+        self.lock = threading.Lock()
+
+    #Write an entry to the log, if there is one, with the given level,
+    #message and extra fields (which only JSON lines have room for)
+    def write_log(self, level, message, fields):
+        if self.log is None:
+            return
+        if self.log_format == LOG_JSON:
+            record = {'time' : time.time(), 'level' : level,\
+                'message' : message}
+            record.update(fields)
+            self.log.write(json.dumps(record) + '\n')
+        else:
+            self.log.write('%s %s %s\n' % (time.strftime('%Y-%m-%d '
+                '%H:%M:%S'), level.upper(), message))
+
+    #Draw the progress line, for every stage in progress
+    def draw(self):
+        now = time.perf_counter()
+        line = ' | '.join(describe_stage(name, stage['unit'],\
+            stage['done'], stage['total'], stage['bytes'],\
+            now - stage['started']) for name, stage in self.stages.items())
+        self.out.write('\r' + line.ljust(self.width))
+        self.out.flush()
+        self.width = len(line)
+        self.drawn = now
+
+    #Write a line to out, moving the progress line down below it
+    def write_line(self, line):
+        if self.width:
+            self.out.write('\r' + ' ' * self.width + '\r')
+            self.width = 0
+        self.out.write(line + '\n')
+        if self.live and self.stages:
+            self.draw()
+
+    #Start a stage, of total items (if known) counted in unit
+    def start(self, name, unit, total = None):
+        with self.lock:
+            self.stages[name] = {'unit' : unit, 'done' : 0,\
+                'total' : total, 'bytes' : 0,\
+                'started' : time.perf_counter()}
+
+    #Count items done in a stage, and the bytes written for them
+    def advance(self, name, count = 1, bytes = 0):
+        with self.lock:
+            stage = self.stages[name]
+            stage['done'] += count
+            stage['bytes'] += bytes
+            if self.live and\
+                    time.perf_counter() - self.drawn >= PROGRESS_INTERVAL:
+                self.draw()
+
+    #Finish a stage, reporting how it went
+    def finish(self, name):
+        with self.lock:
+            stage = self.stages.pop(name)
+            elapsed = time.perf_counter() - stage['started']
+            line = describe_stage(name, stage['unit'], stage['done'],\
+                stage['total'], stage['bytes'], elapsed, True)
+            self.write_log('info', line, {'stage' : name,\
+                'done' : stage['done'], 'bytes' : stage['bytes'],\
+                'seconds' : elapsed})
+            if self.verbosity >= NORMAL:
+                self.write_line(line)
+
+    #Report on an item, with extra fields for the log
+    #(Check self.items first, to save describing items for nothing)
+    def item(self, message, **fields):
+        with self.lock:
+            self.write_log('info', message, fields)
+            if self.verbosity >= VERBOSE:
+                self.write_line(message)
+
+    #Report something about the run as a whole
+    def message(self, message, **fields):
+        with self.lock:
+            self.write_log('info', message, fields)
+            if self.verbosity >= NORMAL:
+                self.write_line(message)
+
+    #Report something that may need looking into, though the run carries
+    #on regardless
+    def warning(self, message, **fields):
+        with self.lock:
+            self.write_log('warning', message, fields)
+            if self.verbosity >= NORMAL:
+                self.write_line("Warning: " + message)
+
+    #Report a failure, which is kept for the summary at the end
+    def failure(self, message, **fields):
+        with self.lock:
+            self.failures.append(message)
+            self.write_log('failure', message, fields)
+            if self.verbosity >= VERBOSE:
+                self.write_line(message)
+
+    #Finish up, with a summary of the failures (whatever the verbosity),
+    #and write out the rest of the log
+    def close(self):
+        with self.lock:
+            if self.failures:
+                self.write_line("Done, with %d problem%s:" %\
+                    (len(self.failures), '' if len(self.failures) == 1\
+                    else 's'))
+                for failure in self.failures:
+                    self.write_line("  " + failure)
+            elif self.verbosity >= NORMAL:
+                self.write_line("Done!")
+            self.out.flush()
+            if self.log is not None:
+                self.log.close()
+                self.log = None
+
+#What's to be organized from a backup: its files (as returned by
+#load_files), the course's name, and its activities, read from catalog
+#(a Catalog), if given, or else from the backup's XML
+#If activity_filter (an ActivityFilter) is given, only the activities it
+#chooses are organized, and the files in their contexts
+#Each backup organized starts afresh, with no paths taken
+class Course:
+    def __init__(self, backup, activity_filter = None, catalog = None):
+        self.backup = backup
+        self.catalog = catalog
+        self.activity_filter = activity_filter
+        content_created.clear()
+        html_created.clear()
+        #Load the files, and the course's contents
+        if catalog is not None:
+            files = catalog.files()
+            self.name = catalog.course_name()
+        else:
+            with backup.open(FILES_XML) as xml_in:
+                files = load_files(xml_in)
+            self.name, self.croot, sections = read_contents(backup)
+        #The members of the chosen activities (or None for all of them),
+        #found before any files are, so no others need be
+        self.selected = None
+        if activity_filter is not None:
+            if catalog is not None:
+                sections = catalog.sections()
+                asections = catalog.activity_sections()
+            else:
+                asections = activity_sections(self.croot)
+            self.selected, contexts = select_activities(self.activities(),\
+                asections, sections, activity_filter)
+            files = select_files(files, contexts)
+        self.files = files
+
+    #Iterate through the chosen activities, as read_activities does
+    def activities(self):
+        if self.catalog is not None:
+            activities = self.catalog.activities(self.activity_filter.mnames\
+                if self.activity_filter is not None else None)
+        else:
+            activities = read_activities(self.backup, self.croot)
+        for mname, amember, axml in activities:
+            if self.selected is None or amember in self.selected:
+                yield mname, amember, axml
+
+    #The number of chosen activities
+    def __len__(self):
+        if self.selected is not None:
+            return len(self.selected)
+        elif self.catalog is not None:
+            return len(self.catalog.activity_sections())
+        return len(self.croot)
+
+    #Choose the paths of the files (see MoodleFile.assign_paths)
+    def assign_paths(self, destination):
+        for file in self.files.values():
+            file.assign_paths(destination)
+
+    #The questions the chosen quizzes use, as load_questions returns them
+    #(or with a catalog, looked up as they're needed)
+    def questions(self):
+        if self.catalog is not None:
+            return self.catalog.questions()
+        question_ids = used_question_ids(self.backup, self.croot,\
+            self.selected)
+        with self.backup.open(QUESTIONS_XML) as xml_in:
+            return load_questions(xml_in, question_ids)
+
+#Renders activities on a pool of processes (or in this one, if processes
+#is 1), each set up by init_worker with initargs
+#Each result is passed to finish (along with the info it was submitted
+#with) in the order they were submitted, with a bounded number in flight
+class ActivityRenderer:
+    def __init__(self, processes, initargs, finish):
+        self.processes = processes
+        self.finish = finish
+        if processes > 1:
+            self.pool = concurrent.futures.ProcessPoolExecutor(processes,\
+                initializer = init_worker, initargs = initargs)
+        else:
+            self.pool = None
+            init_worker(*initargs)
+        #(info, future) for each activity in flight, in order
+        self.pending = collections.deque()
+
+    #Render an activity by calling render with args, in a worker
+    #info is a tuple of arguments for finish, which the result goes after
+    def submit(self, info, render, *args):
+        if self.pool is not None:
+            self.add(info, self.pool.submit(render, *args))
+        else:
+            self.add(info, finished(render(*args)))
+
+    #Add the result of an activity that's done with already (e.g. one
+    #that isn't supported)
+    def add(self, info, future):
+        self.pending.append((info, future))
+        while len(self.pending) > ACTIVITIES_PER_PROCESS * self.processes:
+            self.finish_next()
+
+    #Wait for the first activity in flight, and finish it
+    def finish_next(self):
+        info, future = self.pending.popleft()
+        self.finish(*info, future.result())
+
+    #Finish every activity in flight, and shut the pool down
+    def close(self):
+        while self.pending:
+            self.finish_next()
+        if self.pool is not None:
+            self.pool.shutdown()
+
+#Report the files listed in files.xml that aren't in the backup, once
+#all of them have been looked for, to a Progress (and a Verifier, if
+#given)
+def report_missing(progress, files, verifier = None):
+    for file in files.values():
+        if not file.located():
+            progress.failure("Did not copy file %s, missing from backup "
+                "(%s)" % (file.aliases[0], file.hash),\
+                file = file.aliases[0], hash = file.hash,\
+                status = 'missing')
+            if verifier is not None:
+                verifier.add_missing(file)
+
+#Report on how an activity went (see render_activity) to a Progress
+def report_activity(progress, mname, aname, success, error):
+    fields = {'type' : mname, 'name' : aname,\
+        'status' : STATUS_NAMES.get(success, STATUS_NAMES[UNKNOWN])}
+    if success == FAILURE:
+        progress.failure("Failed to process %s %s%s" % (mname, aname,\
+            ": %s" % error if error is not None else ''), error = error,\
+            **fields)
+    elif not progress.items:
+        return
+    elif success == SUCCESS:
+        progress.item("Processed %s %s" % (mname, aname), **fields)
+    elif success == FILE_EXISTS:
+        progress.item("Did not process %s %s, already exists" %\
+            (mname, aname), **fields)
+    elif success == UNCHANGED:
+        progress.item("Did not process %s %s, unchanged" % (mname, aname),\
+            **fields)
+    elif success == UNSUPPORTED:
+        progress.item("Did not process %s %s, type not supported" %\
+            (mname, aname), **fields)
+
+#Organize the backup at source (a directory or .mbz file) into
+#destination (see the README for what the arguments do)
+#If a BlobStore is given, files are put in it, and linked to from
+#destination using link_mode
+#If profile is the name of a stage (see STAGES), that stage is profiled
+#If catalog is True, the backup's XML is read from a catalog of it in
+#destination, which is built if it's missing or out of date (see Catalog)
+#If pipeline is True, files are copied in the background while the
+#questions are loaded and the activities rendered, each activity as soon
+#as the files in its context are in place
+#If an ActivityFilter is given, only the activities it selects, and the
+#files in their contexts, are organized
+#If resume is True, what an interrupted run did is kept, so that
+#nothing it finished is redone (see Manifest.open_journal)
+#If verify is True, the files copied are checked against their hashes
+#(see Verifier), and the results reported at the end
+#The run is reported on to a Progress, if one is given (which is closed
+#at the end), or else to stdout
+#Returns a dict of statistics about the run (see RunStats.report), with
+#the results of verifying the files under 'verify'
+def organize(source, destination, reset = False, jobs = 1,\
+        link_mode = LINK_COPY, processes = 1, store = None, profile = None,\
+        catalog = False, pipeline = False, activity_filter = None,\
+        resume = False, verify = False, progress = None):
+    if progress is None:
+        progress = Progress()
+    stats = RunStats(profile, os.path.join(destination,\
+        PROFILE_FILENAME % profile) if profile is not None else None)
     #Create the new files and content directories
     new_files_dir = os.path.join(destination, NEW_FILES_DIR)
     new_html_dir = os.path.join(destination, NEW_HTML_DIR)
@@ -268,7 +2568,13 @@ if __name__ == '__main__':
             shutil.rmtree(new_files_dir)
         if os.path.isdir(new_html_dir):
             shutil.rmtree(new_html_dir)
+        for filename in (MANIFEST_FILENAME, JOURNAL_FILENAME):
+            if os.path.isfile(os.path.join(destination, filename)):
+                os.remove(os.path.join(destination, filename))
+
     #Create if necessary
+    if not os.path.isdir(destination):
+        os.mkdir(destination)
     if not os.path.isdir(new_files_dir):
         os.mkdir(new_files_dir)
     if not os.path.isdir(new_html_dir):
@@ -279,330 +2585,751 @@ if __name__ == '__main__':
     if not os.path.islink(files_link):
         os.symlink(os.path.abspath(new_files_dir), files_link)
 
-    #Load the files
-    files = dict()
-    files_by_context = dict()
-    ftree = etree.parse(os.path.join(source, FILES_XML))
-    froot = ftree.getroot()
+    #Open the backup
+    with stats.stage(STAGE_OPEN):
+        backup = open_backup(source)
 
-    for file_entry in froot:
-        # #Get the file's ID
-        # id = file_entry.attrib['id']
-        #Get the file's hash, name, and context id
-        hash = file_entry.find('contenthash').text
-        name = file_entry.find('filename').text
-        context_id = file_entry.find('contextid').text
-
-        #Has this file been found already?
-        if hash in files:
-            #Yes
-            #Just add a new name and context
-            files[hash].add_name(name)
-            files[hash].add_context(context_id)
-        else:
-            #Add an entry to files for this file
-            files[hash] = MoodleFile(hash, name, context_id)
-            # #Add alias by ID
-            # files[id] = files[hash]
-
-    #Find the files
-    old_files_dir = os.path.join(source, OLD_FILES_DIR)
-    for entry in os.listdir(old_files_dir):
-        full_entry = os.path.join(old_files_dir, entry)
-        if os.path.isdir(full_entry):
-            #Find the files in this directory
-            for fentry in os.listdir(full_entry):
-                if fentry in files:
-                    #Process the found file!
-                    file = files[fentry]
-                    file.locate(full_entry)
-                    created = file.copy_over(destination)
-                    for name in file.names.values():
-                        if created:
-                            print("Copied file %s" % name)
-                        else:
-                            print("Did not copy file %s, already exists" % name)
-                    #Track by context
-                    for context_id in file.context_ids:
-                        if context_id not in files_by_context:
-                            files_by_context[context_id] = []
-                        files_by_context[context_id].append(file)
-
-    print()
-    print("Done copying files!")
-
-    #Next, extract the questions
-    questions = dict()
-    qtree = etree.parse(os.path.join(source, QUESTIONS_XML))
-    qroot = qtree.getroot()
-
-    #Iterate through question categories
-    for question_category in qroot:
-        questions_node = question_category.find("questions")
-        #Iterate through questions
-        for question_node in questions_node:
-            #Extract info about it
-            id = question_node.attrib['id']
-            text = question_node.find('questiontext').text
-            type = question_node.find('qtype').text
-            #Store the info
-            questions[id] = {'text' : text, 'type' : type}
-
-            answer_node = question_node.find('plugin_qtype_%s_question' % type)
-            if answer_node is not None:
-                answers = answer_node.find('answers')
-            else:
-                answers = None
-            #Handle essays separately
-            if type == 'essay':
-                template = answer_node.find('essay').\
-                    find('responsetemplate').text
-                if template is not None:
-                    questions[id]['template'] = template
-            elif answers is not None:
-                questions[id]['answers'] = dict()
-                for answer in answers:
-                    #Extract answer info
-                    answer_id = answer.attrib['id']
-                    answer_text = answer.find('answertext').text
-                    answer_fraction = answer.find('fraction').text
-                    answer_feedback = answer.find('feedback').text
-                    #Store answer info
-                    questions[id]['answers'][answer_id] = dict()
-                    adict = questions[id]['answers'][answer_id]
-                    adict['text'] = answer_text
-                    adict['fraction'] = answer_fraction
-                    if answer_feedback is not None:
-                        adict['feedback'] = answer_feedback
-                #Special handling for numericals
-                if type == 'numerical':
-                    #Units not currently handled
-                    #Tolerance
-                    records_node = answer_node.find('numerical_records')
-                    for record_node in records_node:
-                        ans_id = record_node.find('answer').text
-                        tolerance = record_node.find('tolerance').text
-                        if tolerance is not None:
-                            adict = questions[id]['answers'][ans_id]\
-                                ['tolerance'] = tolerance
+    #Catalog the backup, if it hasn't been already
+    if catalog:
+        with stats.stage(STAGE_CATALOG):
+            backup_catalog = Catalog(os.path.join(destination,\
+                CATALOG_FILENAME), backup)
 
+    #What previous runs have done here, picking up where the last left
+    #off if resuming
+    manifest = Manifest(destination, progress)
+    manifest.open_journal(resume)
+    remove_temp_files(new_files_dir)
+    remove_temp_files(new_html_dir)
 
+    #Load the files, and the course's contents, from the catalog or the
+    #backup
+    with stats.stage(STAGE_FILES):
+        course = Course(backup, activity_filter, backup_catalog if catalog\
+            else None)
+        files = course.files
 
-    #Now do the page's contents
-    ctree = etree.parse(os.path.join(source, CONTENT_XML))
-    #Get the root of the content we care about
-    croot = ctree.getroot().find("information").find("contents").\
-        find("activities")
+    #Find the files, going straight to each by its hash, and copy them,
+    #keeping track of which contexts are complete
+    tracker = ContextTracker(files, CatalogContextIndex(backup_catalog,\
+        files) if catalog else None)
+    verifier = Verifier(jobs) if verify else None
+    def place_files():
+        with stats.stage(STAGE_COPY):
+            progress.start(STAGE_COPY, 'files', len(files))
+            try:
+                for file, created in copy_files(backup, files, destination,
+                        jobs, link_mode, manifest, store, verifier):
+                    copied = stats.add_copies(file, created)
+                    tracker.placed(file)
+                    if progress.items:
+                        for path, name in zip(file.paths, file.new_names):
+                            if path in created:
+                                progress.item("Copied file %s" % name,\
+                                    file = name, hash = file.hash,\
+                                    status = 'copied')
+                            else:
+                                progress.item("Did not copy file %s, "
+                                    "already exists" % name, file = name,\
+                                    hash = file.hash, status = 'exists')
+                    progress.advance(STAGE_COPY, 1, copied)
+            finally:
+                tracker.finish()
+                progress.finish(STAGE_COPY)
 
-    for activity in croot:
-        #Get the module name and directory
-        mname = activity.find('modulename').text
-        mdir = os.path.join(source, activity.find('directory').text)
+    if pipeline:
+        copier = concurrent.futures.ThreadPoolExecutor(1)
+        copying = copier.submit(place_files)
+    else:
+        place_files()
+        report_missing(progress, files, verifier)
 
-        #Now, load the activity's XML
-        atree = etree.parse(os.path.join(mdir, "%s.xml" % mname))
-        #Get the root and the child we care about
-        aroot = atree.getroot()
-        achild = aroot.find(mname)
+    #Next, extract the questions the quizzes use
+    with stats.stage(STAGE_QUESTIONS):
+        questions = course.questions()
 
-        #Get the activity's name and context ID
-        aname = achild.find('name').text
-        acontext = aroot.attrib['contextid']
+    #Report on an activity once it's finished, and record it
+    def finish_activity(mname, aname, path, result):
+        success, entry, error, seconds = result
+        stats.add_activity(mname, aname, success, seconds)
+        if success == SUCCESS:
+            record_html(manifest, path, entry)
+        report_activity(progress, mname, aname, success, error)
+        progress.advance(STAGE_ACTIVITIES)
 
-        #Get the contextual files
-        if acontext in files_by_context:
-            context_files = files_by_context[acontext]
-        else:
-            context_files = []
-
-        #print("Attempting to process %s %s" % (mname, aname))
-
-        #Handle the various types
-        success = UNKNOWN
-        #Assignment, resource or folder
-        if mname == ASSIGNMENT or mname == RESOURCE or mname == FOLDER:
-            #Get the HTML content
-            acontent = achild.find('intro').text
-        #Page
-        elif mname == PAGE:
-            #Get the HTML content
-            aintro = achild.find('intro').text
-            acontent = achild.find('content').text
-            if aintro is not None and len(aintro) > 0:
-                acontent = aintro + "\n<br><br>\n" + acontent
-        #URL
-        elif mname == URL:
-            #Get the URL content
-            acontent = achild.find('externalurl').text
-            #Convert to html
-            acontent = '<a href="%s">%s</a>' % (acontent, aname)
-        #Quiz
-        elif mname == QUIZ:
-            #Get the intro content
-            aintro = achild.find('intro').text
-            if aintro is not None and len(aintro) > 0:
-                acontent = aintro + '\n<br><br>\n'
+    #Now do the page's contents
+    with stats.stage(STAGE_ACTIVITIES):
+        progress.start(STAGE_ACTIVITIES, 'activities', len(course))
+        #Render the pages on a pool of processes, or in this one
+        #Each activity's files are sent along with it, since they may
+        #not all have been placed yet
+        renderer = ActivityRenderer(processes, (questions,),\
+            finish_activity)
+        #Activities waiting for the files in their contexts, as
+        #(context ID, module name, name, path, task)
+        waiting = collections.deque()
+
+        #Start rendering an activity, once its context is ready
+        def start_activity(acontext, mname, aname, path, task):
+            renderer.submit((mname, aname, path), timed_render_activity,\
+                *task, tracker.context_files(acontext))
+
+        #Start whichever waiting activities are ready, or if there are
+        #too many waiting, wait for the first of them
+        def start_ready():
+            for activity in list(waiting):
+                if tracker.ready(activity[0]):
+                    waiting.remove(activity)
+                    start_activity(*activity)
+            if len(waiting) > WAITING_ACTIVITIES:
+                tracker.wait(waiting[0][0])
+                start_activity(*waiting.popleft())
+
+        for mname, amember, axml in course.activities():
+            aname, acontext = peek_activity(axml)
+            #Skip it if nothing's changed since the last run
+            #(which can only be told once its files are in place), unless
+            #an activity before it has been given its page's path
+            apath = None
+            if manifest.previous_output(amember) is not None:
+                tracker.wait(acontext)
+                apath = unchanged_activity(manifest, amember, axml,\
+                    tracker.context_files(acontext), questions)
+            if apath is not None and html_created.claim(apath):
+                renderer.add((mname, manifest.get(apath)['title'],\
+                    apath), finished((UNCHANGED, None, None, None)))
+            elif mname not in ACTIVITY_NAMES:
+                renderer.add((mname, aname, None),\
+                    finished((UNSUPPORTED, None, None, None)))
             else:
-                acontent = ''
-            #Process the questions
-            question_nodes = dict()
-            questions_node = achild.find('question_instances')
-            for question_node in questions_node:
-                #Get the ID, page, slot, and maxmark
-                question_id = question_node.find('questionid').text
-                page = int(question_node.find('page').text)
-                slot = int(question_node.find('slot').text)
-                points = question_node.find('maxmark').text
-                #Store for later sorting
-                question_nodes[(page, slot)] = {'id' : question_id,\
-                    'points' : points}
-            #Process the questions in order
-            question_numbers = list(question_nodes.keys())
-            question_numbers.sort()
-            count = 1
-            for question_number in question_numbers:
-                #Re-extract the info
-                question_node = question_nodes[question_number]
-                question_id = question_node['id']
-                #Get the question record
-                question = questions[question_id]
-                #Get the question type
-                question_type = question['type']
-                #Treat descriptions specially
-                if question_type != 'description':
-                    #Get the number of points
-                    points = float(question_node['points'])
-                    acontent += '<b>Question %d</b> (%s)<br>' % (count,\
-                        pointify(points))
-                    #Throw in the type
-                    acontent += '[%s]' % question_type
-                    #Increment the question counter
-                    count += 1
-                else:
-                    acontent += '<b>Instructions:</b> '
-                #Throw in the text
-                acontent += '%s' % question['text']
-                #Throw in template if it's there
-                if 'template' in question:
-                    acontent += '<br>Template: %s<br>' %\
-                        question['template']
-                #Process answers
-                if 'answers' in question:
-                    #Handle multichoice separately
-                    if question_type == 'multichoice':
-                        acontent += '<ol type="a">'
-                    else:
-                        acontent += '<ul>'
-                    for answer_id in question['answers']:
-                        answer = question['answers'][answer_id]
-                        #Text
-                        acontent += '<li>%s' % answer['text']
-                        #Tolerance
-                        if 'tolerance' in answer:
-                            acontent += ' +/- %s' % answer['tolerance']
-                        #Fraction
-                        fraction = answer['fraction']
-                        if fraction is not None:
-                            #Format fraction as a two-decimal percent
-                            acontent += " (%s)" % percentify(float(answer\
-                                ['fraction']))
-                        #Feedback
-                        if 'feedback' in answer:
-                            acontent += '<br><br>Feedback: %s' %\
-                                answer['feedback']
-                        #End list item
-                        acontent += '</li>'
-                    #End list
-                    #Handle multichoice separately
-                    if question_type == 'multichoice':
-                        acontent += '</ol>'
-                    else:
-                        acontent += '</ul>'
-                #Add in extra spacing
-                acontent += '<br>\n'
-        #Other (ignore)
-        else:
-            #Report no copy
-            success = UNSUPPORTED
+                #Choose where it goes here, so names don't depend on the
+                #order the files are placed or the workers finish in
+                path = html_path(destination, aname, mname)
+                replace = manifest.get(path) is not None
+                waiting.append((acontext, mname, aname, path,\
+                    (axml, mname, amember, path, replace)))
+            start_ready()
+        while waiting:
+            tracker.wait(waiting[0][0])
+            start_ready()
+        renderer.close()
+        progress.finish(STAGE_ACTIVITIES)
 
-        if success == UNKNOWN:
-            #Actually try to do a write now
-            try:
-                #Fix up/finalize the HTML
-                if acontent is None or len(acontent) == 0:
-                    acontent = mname.capitalize()
-                html_content = make_html(aname, acontent, context_files)
-                #Do the write
-                success = write_html(destination, aname, mname, html_content)
-            except Exception as ex:
-                print("\nException occurred: {0}\n".format(ex))
-                success = FAILURE
-        #Report on success/failure
-        if success == SUCCESS:
-            print("Processed %s %s" % (mname, aname))
-        elif success == FAILURE:
-            print("Failed to process %s %s" % (mname, aname))
-        elif success == FILE_EXISTS:
-            print("Did not process %s %s, already exists" % (mname, aname))
-        elif success == UNSUPPORTED:
-            print("Did not process %s %s, type not supported" %\
-                (mname, aname))
+    if pipeline:
+        copying.result()
+        copier.shutdown()
+        report_missing(progress, files, verifier)
+
+    counts = {'files' : len(files), 'located' : sum(1 for file in\
+        files.values() if file.located())}
+    if store is not None:
+        counts['written_bytes'] = store.written_bytes
+        counts['reused_bytes'] = store.reused_bytes
+    if verifier is not None:
+        verifier.close()
+        counts['verify'] = verifier.report()
 
     #Construct HTML index
     #Should work even if all files already existed
-    print()
-    print("Constructing HTML index")
+    with stats.stage(STAGE_INDEX):
+        content = make_index(course.name, catalog_pages(new_html_dir,\
+            manifest))
+        #Write the file
+        with atomic_path(os.path.join(new_html_dir, INDEX_FILENAME)) as\
+                temp:
+            with open(temp, 'w') as html_out:
+                html_out.write(content)
+    progress.message("Wrote %s" % INDEX_FILENAME)
+
+    manifest.save()
+    if catalog:
+        backup_catalog.close()
+    backup.close()
+
+    if verifier is not None:
+        progress.message("Verified %d blobs: %d did not match their "
+            "hashes, %d missing" % (verifier.verified,\
+            len(verifier.mismatched), len(verifier.missing)))
+        for file, digest in verifier.mismatched:
+            progress.failure("Mismatched file %s (%s), hashes to %s" %\
+                (file.aliases[0], file.hash, digest),\
+                file = file.aliases[0], hash = file.hash, actual = digest,\
+                status = 'mismatched')
+
+    progress.close()
+    return stats.report(counts)
+
+#Organize the backup at source into a single archive at path (see
+#ArchiveWriter), rather than into a directory
+#Pages link to files relative to themselves, so no link to the content
+#directory is needed in the html directory, and there's nothing from
+#previous runs to skip
+#processes, activity_filter and progress are as for organize
+#Returns a dict of statistics about the run (the files, and how many of
+#them were located)
+def organize_archive(source, path, processes = 1, activity_filter = None,\
+        progress = None):
+    if progress is None:
+        progress = Progress()
+    backup = open_backup(source)
+    archive = ArchiveWriter(path)
+
+    #Load the files, and choose their names
+    course = Course(backup, activity_filter)
+    course.assign_paths('')
+    files = course.files
+
+    #Stream the files into the archive, as they're found
+    progress.start(STAGE_COPY, 'files', len(files))
+    for hash, member in backup.find_blobs(list(files)):
+        file = files[hash]
+        file.locate(backup, member)
+        archive.add_moodle_file(file)
+        if progress.items:
+            for name in file.new_names:
+                progress.item("Copied file %s" % name, file = name,\
+                    hash = file.hash, status = 'copied')
+        progress.advance(STAGE_COPY, 1, backup.size(member))
+    progress.finish(STAGE_COPY)
+
+    report_missing(progress, files)
+
+    #Next, extract the questions the quizzes use
+    questions = course.questions()
+
+    #The pages for the index (see catalog_pages)
     index = dict()
-    for html_file in os.listdir(new_html_dir):
-        #Check if HTML file
-        if html_file[-5:] == '.html':
-            #Find its title and type
-            underscore_index = html_file.find('_')
-            if underscore_index == -1:
-                #What's this file doing here?
-                continue
-            type = html_file[:underscore_index]
-            if type not in ACTIVITY_NAMES:
-                #What's this file doing here?
+
+    #Add a page to the archive once it's been rendered
+    def finish_page(mname, aname, path, result):
+        success, page, error = result
+        if success == SUCCESS:
+            member = archive_member(path)
+            archive.add_bytes(member, page.encode())
+            index.setdefault(ACTIVITY_NAMES[mname], []).append(\
+                (posixpath.basename(member), aname))
+        report_activity(progress, mname, aname, success, error)
+        progress.advance(STAGE_ACTIVITIES)
+
+    #Render the pages on a pool of processes, or in this one
+    renderer = ActivityRenderer(processes, (questions, ContextIndex(files),\
+        ARCHIVE_FILES_DIR), finish_page)
+    progress.start(STAGE_ACTIVITIES, 'activities', len(course))
+    for mname, amember, axml in course.activities():
+        aname, acontext = peek_activity(axml)
+        if mname not in ACTIVITY_NAMES:
+            renderer.add((mname, aname, None),\
+                finished((UNSUPPORTED, None, None)))
+        else:
+            renderer.submit((mname, aname, html_path('', aname, mname)),\
+                render_page, axml, mname)
+    renderer.close()
+    progress.finish(STAGE_ACTIVITIES)
+
+    #Construct HTML index
+    archive.add_bytes(posixpath.join(NEW_HTML_DIR, INDEX_FILENAME),\
+        make_index(course.name, index).encode())
+    progress.message("Wrote %s" % INDEX_FILENAME)
+
+    archive.close()
+    backup.close()
+
+    progress.close()
+    return {'files' : len(files), 'located' : sum(1 for file in\
+        files.values() if file.located())}
+
+#The most recently used pages rendered by a BackupPreview, up to size
+#of them, by name
+class PageCache:
+    def __init__(self, size):
+        self.size = size
+        self.pages = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    #The page with the given name, calling render() to make it if it isn't
+    #cached (outside the lock, so that other pages can be served meanwhile)
+    def get(self, name, render):
+        with self.lock:
+            if name in self.pages:
+                self.pages.move_to_end(name)
+                return self.pages[name]
+        page = render()
+        with self.lock:
+            self.pages[name] = page
+            self.pages.move_to_end(name)
+            while len(self.pages) > self.size:
+                self.pages.popitem(last = False)
+        return page
+
+#The blobs with the given hashes in a backup that can only be read front
+#to back, copied into a temporary directory by a pass through it in the
+#background, so that they can be read in any order
+class BlobSpool:
+    def __init__(self, backup, hashes):
+        self.dir = tempfile.TemporaryDirectory(prefix = TEMP_PREFIX)
+        #The hashes of the blobs spooled so far
+        self.spooled = set()
+        #Set once the pass is over (or should stop)
+        self.done = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target = self.spool,\
+            args = (backup, hashes), daemon = True)
+        self.thread.start()
+
+    def spool(self, backup, hashes):
+        try:
+            for hash, member in backup.find_blobs(hashes):
+                if self.done:
+                    break
+                with backup.open(member) as fin,\
+                        open(os.path.join(self.dir.name, hash), 'wb') as fout:
+                    shutil.copyfileobj(fin, fout, COPY_CHUNK_SIZE)
+                with self.condition:
+                    self.spooled.add(hash)
+                    self.condition.notify_all()
+        finally:
+            with self.condition:
+                self.done = True
+                self.condition.notify_all()
+
+    #Where a blob has been spooled to, waiting for the pass to reach it
+    #Returns None if it isn't in the backup
+    def path(self, hash):
+        with self.condition:
+            self.condition.wait_for(lambda: self.done or\
+                hash in self.spooled)
+            if hash not in self.spooled:
+                return None
+        return os.path.join(self.dir.name, hash)
+
+    def close(self):
+        with self.condition:
+            self.done = True
+        self.thread.join()
+        self.dir.cleanup()
+
+#A backup, ready to have its pages rendered and its files read as
+#they're asked for (see serve), rather than copying and rendering
+#everything up front
+#Only the XML is read to begin with: files.xml, moodle_backup.xml, the
+#questions the quizzes use, and the activities' names for the index
+#Everything is named just as organize would name it
+#Files in a backup that can only be read front to back are spooled (see
+#BlobSpool), and can be read once the pass through it reaches them
+#Pages that fail to render are reported to progress
+class BackupPreview:
+    def __init__(self, source, cache_pages = CACHE_PAGES,\
+            activity_filter = None, progress = None):
+        if progress is None:
+            progress = Progress()
+        self.progress = progress
+        self.backup = open_backup(source)
+
+        #Load the files, and choose their names
+        course = Course(self.backup, activity_filter)
+        course.assign_paths('')
+        files = course.files
+        self.course_name = course.name
+        #Each file, by where it goes (e.g. content/image.png)
+        self.files = dict()
+        for file in files.values():
+            for path in file.paths:
+                self.files[archive_member(path)] = file
+
+        #Locate the files, or start spooling them if they can't be gone to
+        #directly (in which case any missing from the backup are only
+        #found to be when they're asked for)
+        self.spool = None
+        if self.backup.random_access:
+            for hash, member in self.backup.find_blobs(list(files)):
+                files[hash].locate(self.backup, member)
+        else:
+            for file in files.values():
+                file.locate(self.backup, blob_member(file.hash))
+            self.spool = BlobSpool(self.backup, list(files))
+
+        #Next, extract the questions the quizzes use, and get ready to
+        #render pages in this process
+        init_worker(course.questions(), ContextIndex(files))
+
+        #Each page, by its name, as (module name, member), and the pages
+        #for the index (see catalog_pages)
+        self.pages = dict()
+        index = dict()
+        for mname, amember, axml in course.activities():
+            if mname not in ACTIVITY_NAMES:
                 continue
-            with open(os.path.join(new_html_dir, html_file), 'r') as html_in:
-                content = html_in.read()
-                title_index = content.find('<title>')
-                title_index_2 = content.find('</title>')
-                if title_index == -1 or title_index_2 == -1 or\
-                        title_index_2 < title_index:
-                    #What's this file doing here?
-                    continue
-                title = content[title_index + 7 : title_index_2]
-            #Add the file to the index
-            if ACTIVITY_NAMES[type] not in index:
-                index[ACTIVITY_NAMES[type]] = []
-            index[ACTIVITY_NAMES[type]].append((html_file, title))
-    #Start creating the content
-    content = '<html><head><title>'
-    #Get the course name
+            aname, acontext = peek_activity(axml)
+            name = os.path.basename(html_path('', aname, mname))
+            self.pages[name] = (mname, amember)
+            index.setdefault(ACTIVITY_NAMES[mname], []).append((name, aname))
+        self.index = make_index(self.course_name, index).encode()
+        self.cache = PageCache(cache_pages)
+
+    #A page (one of self.pages, or the index), rendered if it isn't cached
+    #Returns None if it can't be rendered
+    def page(self, name):
+        if name == INDEX_FILENAME:
+            return self.index
+        def render():
+            mname, amember = self.pages[name]
+            with self.backup.open(amember) as ain:
+                axml = ain.read()
+            success, page, error = render_page(axml, mname)
+            if error is not None:
+                self.progress.warning("Couldn't render %s: %s" %\
+                    (name, error), page = name, error = error)
+            return page.encode() if page is not None else None
+        return self.cache.get(name, render)
+
+    #Open a file, by where it goes (e.g. content/image.png)
+    #Returns (binary file object, size), or None if it isn't in the backup
+    def open_file(self, path):
+        file = self.files.get(path)
+        if file is None or not file.located():
+            return None
+        if self.spool is not None:
+            blob_path = self.spool.path(file.hash)
+            if blob_path is None:
+                return None
+            return open(blob_path, 'rb'), os.path.getsize(blob_path)
+        return self.backup.open(file.member), self.backup.size(file.member)
+
+    def close(self):
+        if self.spool is not None:
+            self.spool.close()
+        self.backup.close()
+
+#Serves the server's BackupPreview (its preview attribute) over HTTP,
+#laid out like a destination directory: the pages in html, and the files
+#in content (and html/content, where the pages link to them)
+class PreviewHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        preview = self.server.preview
+        path = urllib.parse.unquote(urllib.parse.urlsplit(self.path).path)
+        dir, name = posixpath.split(path.strip('/'))
+        if not name or (dir == '' and name == NEW_HTML_DIR):
+            #Start at the index
+            self.send_response(302)
+            self.send_header('Location', '/%s/%s' % (NEW_HTML_DIR,\
+                INDEX_FILENAME))
+            self.end_headers()
+        elif dir == NEW_HTML_DIR:
+            if name != INDEX_FILENAME and name not in preview.pages:
+                self.send_error(404)
+                return
+            page = preview.page(name)
+            if page is None:
+                self.send_error(500, "Failed to render %s" % name)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            self.send_header('Content-Length', str(len(page)))
+            self.end_headers()
+            self.wfile.write(page)
+        else:
+            if dir == posixpath.join(NEW_HTML_DIR, NEW_FILES_DIR):
+                dir = NEW_FILES_DIR
+            opened = preview.open_file(posixpath.join(dir, name))
+            if opened is None:
+                self.send_error(404)
+                return
+            fin, size = opened
+            with fin:
+                self.send_response(200)
+                self.send_header('Content-Type', mimetypes.guess_type(name)[0]\
+                    or 'application/octet-stream')
+                self.send_header('Content-Length', str(size))
+                self.end_headers()
+                shutil.copyfileobj(fin, self.wfile, COPY_CHUNK_SIZE)
+
+#Serve the backup at source on localhost:port (see BackupPreview and
+#PreviewHandler), for browsing it without organizing it, until interrupted
+#Keeps up to cache_pages rendered pages; activity_filter and progress
+#are as for organize
+def serve(source, port = DEFAULT_PORT, cache_pages = CACHE_PAGES,\
+        activity_filter = None, progress = None):
+    start = time.perf_counter()
+    preview = BackupPreview(source, cache_pages, activity_filter, progress)
+    server = http.server.ThreadingHTTPServer(('localhost', port),\
+        PreviewHandler)
+    server.preview = preview
+    print("Serving %s at http://localhost:%d/ (ready in %.2f s)" %\
+        (preview.course_name, server.server_address[1],\
+        time.perf_counter() - start), flush = True)
     try:
-        course_name = html.unescape(ctree.getroot().find("information").\
-            find("original_course_fullname").text)
-    except:
-        course_name = "Moodle Site"
-    content += 'Index for %s</title></head><body><h1>Index for %s</h1>' %\
-        (course_name, course_name)
-    #Process the index in sorted order
-    types = list(index.keys())
-    types.sort()
-    for type in types:
-        content += '<h2>%s</h2><ul>' % type
-        #Process the files in order
-        index[type].sort(key = lambda entry: natural_keys(entry[0]))
-        for entry in index[type]:
-            content += '\n<li><a href="%s">%s</a></li>' % entry
-        content += '</ul>'
-    content += '</body></html>'
-    #Write the file
-    with open(os.path.join(new_html_dir, INDEX_FILENAME), 'w') as html_out:
-        html_out.write(content)
-    print("Wrote %s" % INDEX_FILENAME)
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        preview.close()
+
+#Write a run's statistics (as returned by organize) to its destination
+def write_stats(destination, stats):
+    with open(os.path.join(destination, STATS_FILENAME), 'w') as out:
+        json.dump(stats, out, indent = 1)
+
+#Find the backups (.mbz files and extracted backup directories) in dir
+def find_backups(dir):
+    backups = []
+    for entry in sorted(os.listdir(dir), key = natural_keys):
+        path = os.path.join(dir, entry)
+        if os.path.isdir(path):
+            if os.path.isfile(os.path.join(path, CONTENT_XML)):
+                backups.append(path)
+        elif entry.lower().endswith(BACKUP_EXTENSION):
+            backups.append(path)
+    return backups
 
-    print()
-    print("Done!")
+#Organize one backup of a batch, in a worker process (see organize_batch)
+#Its output goes to a log in its destination, rather than the terminal,
+#with the given verbosity (see Progress)
+def organize_logged(source, destination, jobs, link_mode, reset, store_dir,\
+        stats = False, profile = None, catalog = False, pipeline = False,\
+        activity_filter = None, resume = False, verify = False,\
+        verbosity = NORMAL):
+    if not os.path.isdir(destination):
+        os.mkdir(destination)
+    store = BlobStore(store_dir)
+    with open(os.path.join(destination, BATCH_LOG_FILENAME), 'w',\
+            buffering = LOG_BUFFER_SIZE) as log:
+        with contextlib.redirect_stdout(log):
+            run_stats = organize(source, destination, reset, jobs,\
+                link_mode, 1, store, profile, catalog, pipeline,\
+                activity_filter, resume, verify, Progress(verbosity))
+    if stats:
+        write_stats(destination, run_stats)
+    return run_stats
+
+#Organize all of the backups in source_dir into subdirectories of
+#destination, named after them, processes at a time
+#Files are stored once, in a store in destination shared by all of the
+#backups, and linked to from each backup's content using link_mode
+#If stats is True, each backup's statistics are written alongside it
+#(see write_stats), and profile, catalog, pipeline, activity_filter,
+#resume and verify are as for organize
+#Each backup's log is written with the given verbosity (see Progress),
+#and at QUIET, only failures are reported here
+#Returns the number of backups with files that failed verification
+def organize_batch(source_dir, destination, processes = 1, jobs = 1,\
+        link_mode = LINK_HARDLINK, reset = False, stats = False,\
+        profile = None, catalog = False, pipeline = False,\
+        activity_filter = None, resume = False, verify = False,\
+        verbosity = NORMAL):
+    store_dir = os.path.join(destination, STORE_DIR)
+    if not os.path.isdir(destination):
+        os.mkdir(destination)
+    if not os.path.isdir(store_dir):
+        os.mkdir(store_dir)
+    #Blobs left half-copied by an interrupted batch would never be
+    #replaced, so clear them out before any course is organized
+    for entry in os.listdir(store_dir):
+        if os.path.isdir(os.path.join(store_dir, entry)):
+            remove_temp_files(os.path.join(store_dir, entry))
+    backups = find_backups(source_dir)
+    written_bytes = 0
+    reused_bytes = 0
+    unverified = 0
+    with concurrent.futures.ProcessPoolExecutor(processes) as pool:
+        runs = []
+        for source in backups:
+            name = os.path.basename(source)
+            if not os.path.isdir(source):
+                name = os.path.splitext(name)[0]
+            runs.append((name, pool.submit(organize_logged, source,\
+                os.path.join(destination, name), jobs, link_mode, reset,\
+                store_dir, stats, profile, catalog, pipeline,\
+                activity_filter, resume, verify, verbosity)))
+        for name, run in runs:
+            try:
+                run_stats = run.result()
+            except Exception as ex:
+                print("Failed to organize %s: %s" % (name, ex))
+                continue
+            written_bytes += run_stats['written_bytes']
+            reused_bytes += run_stats['reused_bytes']
+            if verbosity > QUIET:
+                print("Organized %s (%d of %d files found)" % (name,\
+                    run_stats['located'], run_stats['files']))
+            if verify and (run_stats['verify']['mismatched'] or\
+                    run_stats['verify']['missing']):
+                unverified += 1
+                print("Files in %s failed verification; see its %s" %\
+                    (name, BATCH_LOG_FILENAME))
+    if verbosity > QUIET:
+        print()
+        print("Wrote %d bytes of files; sharing them saved %d bytes" %\
+            (written_bytes, reused_bytes))
+    return unverified
+
+if __name__ == '__main__':
+    #Get arguments
+    parser = argparse.ArgumentParser(description = "Organize the contents "
+        "of a Moodle backup into human-readable files")
+    parser.add_argument('source', help = "the backup (.mbz) file, or the "
+        "directory it has been extracted into")
+    parser.add_argument('dest', nargs = '?', help = "where to put the "
+        "organized content (default: the source directory, or the backup "
+        "file's name minus its extension)")
+    parser.add_argument(RESET_FLAG, action = 'store_true', help = "delete "
+        "existing content and html directories first")
+    parser.add_argument(JOBS_FLAG, type = int, default = 1, metavar = 'N',
+        help = "number of files to copy at once (default: 1)")
+    parser.add_argument(PROCESSES_FLAG, type = int, default = 1,
+        metavar = 'N', help = "number of processes to render activities "
+        "on (default: 1)")
+    parser.add_argument(LINK_MODE_FLAG, choices = LINK_MODES,
+        help = "how to put files in place when the source is a directory "
+        "(or, with %s, the shared store); reflinks fall back on copying "
+        "where unsupported (default: copy, or hardlink with %s)" %\
+        (BATCH_FLAG, BATCH_FLAG))
+    parser.add_argument(BATCH_FLAG, action = 'store_true', help = "source "
+        "is a directory of backups; organize each into a directory of the "
+        "same name in dest, storing files shared between them only once, "
+        "and using %s for the number of backups organized at once" %\
+        PROCESSES_FLAG)
+    parser.add_argument(STATS_FLAG, action = 'store_true', help = "write "
+        "timings and counts for the run to %s in dest (in batch mode, in "
+        "each backup's directory)" % STATS_FILENAME)
+    parser.add_argument(PROFILE_FLAG, choices = STAGES, metavar = 'STAGE',
+        help = "profile one stage of the run (one of %s) with cProfile, "
+        "dumping the results to %s in dest" % (', '.join(STAGES),\
+        PROFILE_FILENAME % 'STAGE'))
+    parser.add_argument(CATALOG_FLAG, action = 'store_true', help = "keep "
+        "a catalog of the backup's XML in dest (%s), so that it's only "
+        "parsed on the first run, and again whenever it changes" %\
+        CATALOG_FILENAME)
+    parser.add_argument(ARCHIVE_FLAG, action = 'store_true', help = "write "
+        "the output into a single archive, dest, instead of a directory, "
+        "in the format given by its extension (one of %s; default: the "
+        "source's name with the extension %s)" % (', '.join(ARCHIVE_FORMATS),\
+        ARCHIVE_EXTENSION))
+    parser.add_argument(PIPELINE_FLAG, action = 'store_true', help = "copy "
+        "files in the background while the questions are loaded and the "
+        "activities rendered")
+    parser.add_argument(RESUME_FLAG, action = 'store_true', help = "pick "
+        "up where an interrupted run on the same dest left off")
+    parser.add_argument(MODULE_FLAG, action = 'append',\
+        choices = list(ACTIVITY_NAMES), help = "only organize activities "
+        "of this type, and the files in them (can be given more than once)")
+    parser.add_argument(NAME_FLAG, metavar = 'PATTERN', help = "only "
+        "organize activities whose names match this regular expression, "
+        "and the files in them")
+    parser.add_argument(SECTION_FLAG, action = 'append', help = "only "
+        "organize activities in the course section with this ID or title, "
+        "and the files in them (can be given more than once)")
+    parser.add_argument(VERIFY_FLAG, action = 'store_true', help = "check "
+        "each file copied against the hash it's stored under, reporting "
+        "any that don't match or are missing at the end (and exiting with "
+        "status 1)")
+    parser.add_argument(SERVE_FLAG, action = 'store_true', help = "serve "
+        "the backup on localhost for browsing, rendering each page as it's "
+        "asked for, instead of organizing it (dest is ignored)")
+    parser.add_argument(PORT_FLAG, type = int, default = DEFAULT_PORT,
+        metavar = 'N', help = "port to serve on with %s (default: %d)" %\
+        (SERVE_FLAG, DEFAULT_PORT))
+    parser.add_argument(CACHE_PAGES_FLAG, type = int, default = CACHE_PAGES,
+        metavar = 'N', help = "number of rendered pages to keep with %s "
+        "(default: %d)" % (SERVE_FLAG, CACHE_PAGES))
+    verbosity = parser.add_mutually_exclusive_group()
+    verbosity.add_argument(QUIET_FLAG, dest = 'verbosity',\
+        action = 'store_const', const = QUIET, default = NORMAL,\
+        help = "only report failures, at the end")
+    verbosity.add_argument(VERBOSE_FLAG, dest = 'verbosity',\
+        action = 'store_const', const = VERBOSE, help = "report on every "
+        "file and activity, as well as the progress of each stage")
+    parser.add_argument(LOG_FLAG, metavar = 'FILE', help = "log every "
+        "file and activity, and the failures, to FILE, whatever the "
+        "verbosity")
+    parser.add_argument(LOG_FORMAT_FLAG, choices = LOG_FORMATS,\
+        default = LOG_TEXT, help = "format of the log given with %s: "
+        "lines of text, or JSON objects with a field for each detail "
+        "(default: %s)" % (LOG_FLAG, LOG_TEXT))
+    args = parser.parse_args()
+    if args.jobs < 1:
+        parser.error("%s must be at least 1" % JOBS_FLAG)
+    if args.processes < 1:
+        parser.error("%s must be at least 1" % PROCESSES_FLAG)
+    if args.archive and args.batch:
+        parser.error("%s can't be used with %s" % (ARCHIVE_FLAG, BATCH_FLAG))
+    if args.serve and (args.batch or args.archive):
+        parser.error("%s can't be used with %s or %s" % (SERVE_FLAG,\
+            BATCH_FLAG, ARCHIVE_FLAG))
+    if args.verify and (args.serve or args.archive):
+        parser.error("%s can't be used with %s or %s" % (VERIFY_FLAG,\
+            SERVE_FLAG, ARCHIVE_FLAG))
+    if args.cache_pages < 1:
+        parser.error("%s must be at least 1" % CACHE_PAGES_FLAG)
+    if args.resume and (args.reset or args.archive):
+        parser.error("%s can't be used with %s or %s" % (RESUME_FLAG,\
+            RESET_FLAG, ARCHIVE_FLAG))
+    if args.archive:
+        #Archives are always written from scratch, one file at a time
+        unused = [flag for flag, given in ((RESET_FLAG, args.reset),\
+            (JOBS_FLAG, args.jobs != 1),\
+            (LINK_MODE_FLAG, args.link_mode is not None),\
+            (STATS_FLAG, args.stats), (PROFILE_FLAG, args.profile),\
+            (CATALOG_FLAG, args.catalog), (PIPELINE_FLAG, args.pipeline))\
+            if given]
+        if unused:
+            parser.error("%s can't be used with %s" % (', '.join(unused),\
+                ARCHIVE_FLAG))
+    if args.log is not None and (args.batch or args.serve):
+        parser.error("%s can't be used with %s or %s (in batch mode, each "
+            "backup is logged to its %s)" % (LOG_FLAG, BATCH_FLAG,\
+            SERVE_FLAG, BATCH_LOG_FILENAME))
+    #Which activities to organize
+    activity_filter = None
+    if args.module or args.name or args.section:
+        try:
+            activity_filter = ActivityFilter(args.module, args.name,\
+                args.section)
+        except re.error as ex:
+            parser.error("%s: %s" % (NAME_FLAG, ex))
+
+    #Extract the source
+    source = args.source
+    #Extract the destination
+    if args.dest is not None:
+        destination = args.dest
+    elif args.archive:
+        #An archive named after the source
+        destination = (source.rstrip(os.sep) if os.path.isdir(source) else\
+            os.path.splitext(source)[0]) + ARCHIVE_EXTENSION
+    elif os.path.isdir(source) or args.batch:
+        #If not given, use source as destination
+        destination = source
+    else:
+        #Backup file, so use its name without the extension
+        destination = os.path.splitext(source)[0]
+    if args.serve:
+        serve(source, args.port, args.cache_pages, activity_filter,\
+            Progress(args.verbosity))
+    elif args.archive:
+        try:
+            archive_mode(destination)
+        except ValueError as ex:
+            parser.error(str(ex))
+        organize_archive(source, destination, args.processes,\
+            activity_filter, Progress(args.verbosity, args.log,\
+            args.log_format))
+    elif args.batch:
+        #Organize every backup in source
+        if organize_batch(source, destination, args.processes, args.jobs,\
+                args.link_mode or LINK_HARDLINK, args.reset, args.stats,\
+                args.profile, args.catalog, args.pipeline, activity_filter,\
+                args.resume, args.verify, args.verbosity):
+            sys.exit(1)
+    else:
+        stats = organize(source, destination, args.reset, args.jobs,\
+            args.link_mode or LINK_COPY, args.processes, profile =\
+            args.profile, catalog = args.catalog, pipeline = args.pipeline,\
+            activity_filter = activity_filter, resume = args.resume,\
+            verify = args.verify, progress = Progress(args.verbosity,\
+            args.log, args.log_format))
+        if args.stats:
+            write_stats(destination, stats)
+        if args.verify and (stats['verify']['mismatched'] or\
+                stats['verify']['missing']):
+            sys.exit(1)
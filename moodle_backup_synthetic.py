@@ -0,0 +1,241 @@
+#Generate synthetic Moodle backups, for testing and benchmarking
+#moodle_backup_organize.py without a real course backup
+#Run as python3 moodle_backup_synthetic.py dest [options]; see --help
+
+import os
+import random
+import hashlib
+import argparse
+import tarfile
+import tempfile
+import urllib.parse
+from html import escape
+
+import moodle_backup_organize as mbo
+
+#Activities that aren't supported, to make sure they're skipped properly
+UNSUPPORTED_ACTIVITY = 'forum'
+
+#Question types, and how often each appears in the bank
+QUESTION_TYPES = ['multichoice'] * 4 + ['shortanswer', 'truefalse',\
+    'numerical', 'essay', 'description', 'multianswer']
+
+#File names, roughly as common as they are in real courses
+FILE_NAMES = ['image.png', 'image.png', 'image.png', 'Screenshot.png',\
+    'lecture %d.pdf', 'notes %d.pdf', 'worksheet %d.docx', 'figure %d.jpg',\
+    'data %d.csv', 'slides %d.pptx']
+
+#Defaults for the generator's parameters (see generate_backup)
+DEFAULTS = {'files' : 200, 'aliases' : 0.2, 'contexts' : 1.2,\
+    'questions' : 100, 'quiz_slots' : 10, 'activities' : 30,\
+    'sections' : 10, 'min_size' : 256, 'max_size' : 64 * 1024,\
+    'embed' : 0.5, 'seed' : 0}
+
+#Write an XML file, given its root element as a string
+def write_xml(path, root):
+    with open(path, 'w') as out:
+        out.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        out.write(root)
+
+#Generate the blobs, files.xml entries and embeddable names of a backup
+#Returns a dict mapping context IDs to the names of the files in them
+def generate_files(path, contexts, rng, files, aliases, contexts_per_file,\
+        min_size, max_size):
+    names_by_context = dict()
+    entries = []
+    for i in range(files):
+        size = rng.randint(min_size, max_size)
+        data = ('%d ' % i).encode() +\
+            rng.getrandbits(8 * size + 8).to_bytes(size + 1, 'little')[1:]
+        hash = hashlib.sha1(data).hexdigest()
+        blob_dir = os.path.join(path, mbo.OLD_FILES_DIR, hash[:2])
+        os.makedirs(blob_dir, exist_ok = True)
+        with open(os.path.join(blob_dir, hash), 'wb') as out:
+            out.write(data)
+        #Each blob is in at least one context, and may be in more, under
+        #the same or another name
+        count = int(contexts_per_file) +\
+            (rng.random() < contexts_per_file % 1)
+        for j in range(max(count, 1)):
+            context_id = rng.choice(contexts)
+            name = rng.choice(FILE_NAMES)
+            if '%d' in name:
+                name = name % i
+            if j > 0 and rng.random() >= aliases:
+                #Same name, different context
+                name = entries[-1][2]
+            entries.append((hash, context_id, name, len(data)))
+            names_by_context.setdefault(context_id, []).append(name)
+    parts = ['<files>\n']
+    for id, (hash, context_id, name, size) in enumerate(entries):
+        parts.append('  <file id="%d">\n'
+            '    <contenthash>%s</contenthash>\n'
+            '    <contextid>%s</contextid>\n'
+            '    <component>mod_resource</component>\n'
+            '    <filearea>content</filearea>\n'
+            '    <itemid>0</itemid>\n'
+            '    <filepath>/</filepath>\n'
+            '    <filename>%s</filename>\n'
+            '    <userid>2</userid>\n'
+            '    <filesize>%d</filesize>\n'
+            '  </file>\n' % (id + 1, hash, context_id, escape(name), size))
+    parts.append('</files>\n')
+    write_xml(os.path.join(path, mbo.FILES_XML), ''.join(parts))
+    return names_by_context
+
+#Generate questions.xml, with count questions of all sorts
+def generate_questions(path, rng, count):
+    parts = ['<question_categories>\n']
+    for i in range(count):
+        if i % 50 == 0:
+            if i > 0:
+                parts.append('</questions></question_category>\n')
+            parts.append('<question_category id="%d"><name>Category %d'
+                '</name><questions>\n' % (i // 50 + 1, i // 50 + 1))
+        type = rng.choice(QUESTION_TYPES)
+        parts.append('<question id="%d"><parent>0</parent><name>Q%d</name>'
+            '<questiontext>%s</questiontext><qtype>%s</qtype>' % (i + 1,\
+            i + 1, escape('<p>Question %d: what is %d + %d? \\(x^2\\)</p>' %\
+            (i + 1, i, rng.randint(0, 99))), type))
+        if type == 'multianswer':
+            #A Cloze question, whose parts are questions of their own,
+            #listed in a nested question element (as in real backups)
+            parts.append('<plugin_qtype_multianswer_question>'
+                '<multianswer id="%d"><question>%d</question><sequence>%d'
+                '</sequence></multianswer></plugin_qtype_multianswer_question>'
+                % (i + 1, i + 2, i + 2))
+        elif type == 'essay':
+            parts.append('<plugin_qtype_essay_question><essay id="%d">'
+                '<responseformat>editor</responseformat><responsetemplate>'
+                'Show your work.</responsetemplate></essay>'
+                '</plugin_qtype_essay_question>' % (i + 1))
+        elif type != 'description':
+            answers = 2 if type == 'truefalse' else rng.randint(1, 5)
+            parts.append('<plugin_qtype_%s_question><answers>' % type)
+            for j in range(answers):
+                parts.append('<answer id="%d"><answertext>%s</answertext>'
+                    '<answerformat>1</answerformat><fraction>%s</fraction>'
+                    '<feedback>%s</feedback></answer>' % (i * 10 + j,\
+                    escape('<p>Answer %d</p>' % j),\
+                    '1.0000000' if j == 0 else '0.0000000',\
+                    'Well done' if j == 0 else ''))
+            parts.append('</answers>')
+            if type == 'numerical':
+                parts.append('<numerical_records>')
+                for j in range(answers):
+                    parts.append('<numerical_record id="%d"><answer>%d'
+                        '</answer><tolerance>0.%d</tolerance>'
+                        '</numerical_record>' % (i * 10 + j, i * 10 + j, j))
+                parts.append('</numerical_records>')
+            parts.append('</plugin_qtype_%s_question>' % type)
+        parts.append('</question>\n')
+    if count > 0:
+        parts.append('</questions></question_category>\n')
+    parts.append('</question_categories>\n')
+    write_xml(os.path.join(path, mbo.QUESTIONS_XML), ''.join(parts))
+
+#The XML for one activity of the given type
+def activity_xml(rng, type, id, context_id, names, questions, quiz_slots,\
+        embed):
+    intro = '<p>Introduction to %s %d.</p>' % (type, id)
+    #Embed some of the activity's files
+    for name in names:
+        if rng.random() < embed:
+            intro += '<p><img src="%s%s?time=%d" alt=""></p>' %\
+                (mbo.MOODLE_PLUGIN_FILE, urllib.parse.quote(name),\
+                rng.randint(0, 10 ** 9))
+    parts = ['<activity id="%d" moduleid="%d" modulename="%s" '
+        'contextid="%d">\n<%s id="%d"><name>%s %d</name><intro>%s</intro>'
+        % (id, id, type, context_id, type, id, type.capitalize(), id,\
+        escape(intro))]
+    if type == mbo.PAGE:
+        parts.append('<content>%s</content>' % escape('<p>%s</p>' %\
+            ' '.join(['Lorem ipsum dolor sit amet.'] * rng.randint(1, 50))))
+    elif type == mbo.URL:
+        parts.append('<externalurl>https://example.com/%d</externalurl>' % id)
+    elif type == mbo.QUIZ:
+        parts.append('<question_instances>')
+        for slot in range(1, min(quiz_slots, questions) + 1):
+            parts.append('<question_instance id="%d"><slot>%d</slot>'
+                '<page>%d</page><questionid>%d</questionid>'
+                '<maxmark>%d.0000000</maxmark></question_instance>' %\
+                (id * 1000 + slot, slot, (slot - 1) // 5 + 1,\
+                rng.randint(1, questions), rng.randint(1, 4)))
+        parts.append('</question_instances>')
+    parts.append('</%s>\n</activity>\n' % type)
+    return ''.join(parts)
+
+#Generate a synthetic backup in the directory path
+#files: number of distinct files (blobs)
+#aliases: chance that a file appearing again does so under another name
+#contexts: average number of contexts each file appears in
+#questions: size of the question bank
+#quiz_slots: number of questions in each quiz
+#activities: number of activities, of every supported type and one not
+#sections: number of course sections the activities are spread over
+#min_size, max_size: range of file sizes, in bytes
+#embed: chance that an activity's file is embedded in its intro
+def generate_backup(path, files = DEFAULTS['files'],\
+        aliases = DEFAULTS['aliases'], contexts = DEFAULTS['contexts'],\
+        questions = DEFAULTS['questions'],\
+        quiz_slots = DEFAULTS['quiz_slots'],\
+        activities = DEFAULTS['activities'],\
+        sections = DEFAULTS['sections'], min_size = DEFAULTS['min_size'],\
+        max_size = DEFAULTS['max_size'], embed = DEFAULTS['embed'],\
+        seed = DEFAULTS['seed']):
+    rng = random.Random(seed)
+    os.makedirs(os.path.join(path, mbo.OLD_FILES_DIR), exist_ok = True)
+    types = list(mbo.ACTIVITY_NAMES) + [UNSUPPORTED_ACTIVITY]
+    #(type, id, context ID, section) for each activity
+    activity_list = [(types[i % len(types)], i + 1, 1000 + i,\
+        i * sections // max(activities, 1) + 1) for i in range(activities)]
+    contexts_list = [activity[2] for activity in activity_list] or [1]
+    names_by_context = generate_files(path, contexts_list, rng, files,\
+        aliases, contexts, min_size, max_size)
+    generate_questions(path, rng, questions)
+    parts = ['<moodle_backup><information><name>synthetic.mbz</name>'
+        '<original_course_fullname>Synthetic Course &amp; Friends'
+        '</original_course_fullname><contents><activities>\n']
+    for type, id, context_id, section in activity_list:
+        directory = 'activities/%s_%d' % (type, id)
+        parts.append('<activity><moduleid>%d</moduleid><sectionid>%d'
+            '</sectionid><modulename>%s</modulename><title>%s %d</title>'
+            '<directory>%s</directory></activity>\n' % (id, section, type,\
+            type.capitalize(), id, directory))
+        os.makedirs(os.path.join(path, directory), exist_ok = True)
+        write_xml(os.path.join(path, directory, '%s.xml' % type),\
+            activity_xml(rng, type, id, context_id,\
+            names_by_context.get(context_id, []), questions, quiz_slots,\
+            embed))
+    parts.append('</activities><sections>\n')
+    for section in range(1, sections + 1):
+        parts.append('<section><sectionid>%d</sectionid><title>Week %d'
+            '</title><directory>sections/section_%d</directory>'
+            '</section>\n' % (section, section, section))
+    parts.append('</sections></contents></information></moodle_backup>\n')
+    write_xml(os.path.join(path, mbo.CONTENT_XML), ''.join(parts))
+
+#Pack the backup in directory path into a .mbz (tar.gz) file
+def pack_backup(path, mbz_path):
+    with tarfile.open(mbz_path, 'w:gz') as archive:
+        for entry in sorted(os.listdir(path)):
+            archive.add(os.path.join(path, entry), entry)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Generate a synthetic "
+        "Moodle backup")
+    parser.add_argument('dest', help = "directory to generate the backup "
+        "in, or .mbz file to generate it as")
+    for name, default in DEFAULTS.items():
+        parser.add_argument('--' + name.replace('_', '-'),\
+            type = type(default), default = default,\
+            help = "(default: %s)" % default)
+    args = parser.parse_args()
+    params = {name : getattr(args, name) for name in DEFAULTS}
+    if args.dest.lower().endswith(mbo.BACKUP_EXTENSION):
+        with tempfile.TemporaryDirectory() as tmp:
+            generate_backup(tmp, **params)
+            pack_backup(tmp, args.dest)
+    else:
+        generate_backup(args.dest, **params)
+    print("Generated %s" % args.dest)